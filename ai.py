@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: Utf-8 -*-
+
+"""AI for Swap
+
+The AI searches the horizontal swaps of a grid and values each one by the
+combos it makes, as Grid.combosAfterSwap finds them, and by the chain they
+trigger, as Grid.resolveInstant plays it. Swaps are tried in place
+on the grid within transactions rolled back afterwards, so no board is ever
+copied.
+
+Chain values can be cached in a TranspositionTable by the Zobrist hash of the
+grid after the swap, since the same boards come up again in successive
+iterations of the search, and from one search to the next while the grid is
+unchanged.
+"""
+
+from time import perf_counter
+from collections import OrderedDict
+
+
+SETUP_DISCOUNT = .5 # Weight of the combos made by a swap following a setup swap
+TABLE_SIZE = 1 << 14 # Number of chain values kept by a transposition table
+
+class BudgetExceeded(Exception):
+	"""Raised once the budget is spent. partial is the best (value, swap) among
+the first swaps the search fully tried."""
+	partial = (0, None)
+
+class Budget(object):
+	"""Search budget, in time and in number of swaps tried.
+
+A budget in swaps keeps the search deterministic."""
+
+	def __init__(self, timeBudget=None, nodeBudget=None):
+		self.deadline = perf_counter() + timeBudget if timeBudget != None else float('inf')
+		self.nodes = nodeBudget if nodeBudget != None else float('inf')
+
+	def spend(self):
+		"""Account for one more swap tried, raise BudgetExceeded if there is none left"""
+		self.nodes -= 1
+		if self.nodes < 0 or perf_counter() > self.deadline:
+			raise BudgetExceeded()
+
+class TranspositionTable(object):
+	"""Values of the chains started by a swap, by grid hash after the swap, the
+least recently used ones being dropped beyond size"""
+
+	def __init__(self, size=TABLE_SIZE):
+		self.size = size
+		self.values = OrderedDict()
+		self.hits = self.misses = 0
+
+	def get(self, key):
+		"""Return the value of key, None if it is not cached"""
+		value = self.values.get(key)
+		if value == None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.values.move_to_end(key)
+		return value
+
+	def put(self, key, value):
+		self.values[key] = value
+		if len(self.values) > self.size:
+			self.values.popitem(last=False)
+
+	def clear(self):
+		self.values.clear()
+
+def legalSwaps(grid):
+	"""Yield the position of every swap that changes the grid"""
+	for x in range(grid.width - 1):
+		left, right = grid[x], grid[x+1]
+		for y in range(min(grid.columnTop(x), grid.columnTop(x+1)), grid.height):
+			if left[y] != right[y]:
+				yield (x, y)
+
+def swapValue(grid, x, y, table=None):
+	"""Return the score of the chain started by the swap at (x, y), already done.
+
+The chain value is looked up in and added to table, if given. The grid is left
+resolved, unless the value was found in table."""
+	if grid.lowerHoles([x, x+1]): return 0 # A swapped block falls
+	if not grid.combosAfterSwap((x, y)): return 0
+	resolve = lambda: sum(score for comboGroup, score in grid.resolveInstant(changed=((x, y), (x+1, y))))
+	if table == None: return resolve()
+	key = grid.hash
+	value = table.get(key)
+	if value == None:
+		value = resolve()
+		table.put(key, value)
+	return value
+
+def search(grid, depth, budget, table=None):
+	"""Return the best value reachable with depth successive swaps, and the first swap.
+
+Swaps following a swap that makes a combo are not searched, since the combo
+blocks are about to be destroyed. If the grid keeps bitboards, the last swap
+is only searched among those making a combo. Chain values are cached in table,
+if given: a cached value spends the same budget, so the search result does not
+depend on the table. Raise BudgetExceeded once budget is spent, with the best
+result found so far."""
+	best, bestSwap = 0, None
+	swaps = legalSwaps(grid)
+	if depth == 1 and grid.hasBitboards(): # Other last swaps are worth 0
+		swaps = grid.comboSwaps()
+	try:
+		for x, y in swaps:
+			budget.spend()
+			grid.begin()
+			try:
+				grid.swap(x, y)
+				value = swapValue(grid, x, y, table)
+				if not value and depth > 1:
+					value = SETUP_DISCOUNT * search(grid, depth - 1, budget, table)[0]
+			finally:
+				grid.rollback()
+			if value > best:
+				best, bestSwap = value, (x, y)
+	except BudgetExceeded as e:
+		e.partial = (best, bestSwap) # Set by each level, the first one last
+		raise
+	return best, bestSwap
+
+def chooseSwap(grid, depth=2, timeBudget=.1, nodeBudget=None, rng=None, table=None):
+	"""Return the swap position to play, searching deeper while the budget allows.
+
+timeBudget is in seconds and nodeBudget in swaps tried, None meaning no limit.
+Fall back to a random swap, drawn from rng or the grid one, when no searched
+swap makes a combo. A pass cut short by the budget still gives its best swap
+if it beats the previous pass.
+
+table is a TranspositionTable kept from one search to the next. It is not used
+while the grid has combos, since a chain then also depends on whether the swap
+touches them, and not only on the blocks."""
+	budget = Budget(timeBudget, nodeBudget)
+	if table != None:
+		grid.enableHash()
+		if grid.combosAll(): table = None
+	bestValue, bestSwap = 0, None
+	for d in range(1, depth + 1):
+		try:
+			value, swap = search(grid, d, budget, table)
+		except BudgetExceeded as e:
+			value, swap = e.partial
+			if value > bestValue: bestSwap = swap # Better than the last full pass
+			break
+		if swap: bestValue, bestSwap = value, swap
+	return bestSwap if bestSwap else grid.randomSwap(rng)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: Utf-8 -*-
+
+"""Self-play farm for Swap
+
+Seeded AI vs AI matches are spread over a pool of processes. Each worker
+keeps a single game and resets it between matches. Its grids come from a
+pool, which generates the grids of the next match in the background.
+Matches stream back as compact records, and the histograms of scores, combo
+sizes and chain lengths are merged at the end.
+
+usage: farm.py [-n MATCHES] [-j JOBS] [--seed SEED] [--duration SECONDS]
+"""
+
+import os
+import argparse
+from time import perf_counter
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from swap import Game, Player
+from grid import GridPool
+from sim import simulate
+
+
+_game = None # Game reused by the worker process
+
+def initWorker():
+	global _game
+	_game = Game([Player('AI', 'BOT#0'), Player('AI', 'BOT#1')],
+		gridPool=GridPool(*Player.GRID_SIZE, background=True))
+
+def playMatch(args):
+	"""Play a match in the worker process and return its record:
+(seed, steps, ((score, comboSizes, chainLengths) for each player))"""
+	seed, duration = args
+	_game.prepare(seed + 1) # The matches of a chunk have consecutive seeds
+	result = simulate(seed, duration, game=_game)
+	return (seed, result['steps'], tuple((p['score'],
+		tuple(p['comboSizes'].items()), tuple(p['chainLengths'].items()))
+		for p in result['players']))
+
+def printHistogram(title, counter, width=50):
+	print(title)
+	top = max(counter.values(), default=0)
+	for key in sorted(counter):
+		print('{:>8} {:>8} {}'.format(key, counter[key], '#' * max(1, round(width * counter[key] / top))))
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Run seeded AI vs AI Swap matches on a process pool.')
+	parser.add_argument('-n', '--matches', type=int, default=1000, help='number of matches')
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+	parser.add_argument('--seed', type=int, default=0, help='seed of the first match')
+	parser.add_argument('--duration', type=float, default=180, help='virtual duration of a match, in seconds')
+	parser.add_argument('--bucket', type=int, default=100, help='width of the score histogram buckets')
+	parser.add_argument('-v', '--verbose', action='store_true', help='print the record of each match')
+	args = parser.parse_args(argv)
+	if args.seed < 0: parser.error('SEED must not be negative')
+
+	scores, comboSizes, chainLengths = Counter(), Counter(), Counter()
+	nbSteps = 0
+	tasks = ((seed, args.duration) for seed in range(args.seed, args.seed + args.matches))
+	chunkSize = max(1, args.matches // (args.jobs * 8))
+
+	t = perf_counter()
+	with ProcessPoolExecutor(args.jobs, initializer=initWorker) as executor:
+		for record in executor.map(playMatch, tasks, chunksize=chunkSize):
+			if args.verbose: print(record)
+			nbSteps += record[1]
+			for score, sizes, chains in record[2]:
+				scores[score // args.bucket * args.bucket] += 1
+				comboSizes.update(dict(sizes))
+				chainLengths.update(dict(chains))
+	elapsed = perf_counter() - t
+
+	printHistogram('Scores', scores)
+	printHistogram('Combo sizes', comboSizes)
+	printHistogram('Chain lengths', chainLengths)
+	print('{} matches, {} steps in {:.1f}s: {:.0f} steps/s'.format(
+		args.matches, nbSteps, elapsed, nbSteps / elapsed))
+
+if __name__ == '__main__':
+	main()
@@ -3,8 +3,14 @@
 """Grid for Swap"""
 
 import sys
-from random import randrange
-from itertoolsExt import indexFalse
+import re
+from array import array
+from contextlib import contextmanager
+from functools import lru_cache
+import random
+import queue
+import threading
+from itertoolsExt import flatten
 try:
 	from collections.abc import Sequence, MutableSequence
 except ImportError:
@@ -17,193 +23,546 @@ FG_DCOLORS = ['\033[90m', '\033[91m', '\033[93m', '\033[94m', '\033[92m', '\033[
 # bg colors order: black, red, yellow(=brown), blue, green, magenta, cyan
 BG_LCOLORS = ['\033[40m', '\033[101m', '\033[103m', '\033[104m', '\033[102m', '\033[105m', '\033[106m', '\033[47m']
 BG_DCOLORS = ['\033[40m', '\033[41m', '\033[43m', '\033[44m', '\033[42m', '\033[45m', '\033[46m', '\033[47m']
+SCORES = [2, 3, 5, 10, 20, 50, 100, 200, 400, 600, 800]
+scoreIt = lambda x: SCORES[x-3] if x <= 10 else 1000
+
+ZOBRIST_SEED = 0x5a0b # Seed of the Zobrist keys, fixed so that hashes are reproducible
+RUN_PATTERN = rb'([^\x00])\1{%d,}' # Run of identical blocks, void excluded
+
 fgcolors = lambda i: FG_DCOLORS[i] if i < 7 else '\033[97m'
 bgcolors = lambda i: BG_DCOLORS[i] if i < 7 else '\033[97m'
 
+def scanRuns(blocks, minLen=3):
+	"""Yield (start, length, color) for each run of at least minLen identical
+blocks in the bytes-like sequence, void excluded"""
+	for m in re.finditer(RUN_PATTERN % (minLen - 1), blocks):
+		start, end = m.span()
+		yield (start, end - start, blocks[start])
+
+@lru_cache()
+def allowedColors(nbSymbols):
+	"""Return the table of the colors making no combo, indexed by the color of
+the pair of blocks below then on the left, 0 if there is no such pair"""
+	assert nbSymbols >= 4, 'at least 3 colors are needed to generate a grid without combo!'
+	return [[tuple(color for color in range(1, nbSymbols) if color not in (below, left))
+		for left in range(nbSymbols)] for below in range(nbSymbols)]
+
+@lru_cache()
+def zobristKeys(size, nbSymbols):
+	"""Return the Zobrist keys of each cell index, as a tuple indexed by color.
+
+Voids have a null key, so they leave the hash unchanged."""
+	rng = random.Random(ZOBRIST_SEED)
+	return [(0,) + tuple(rng.getrandbits(64) for color in range(1, nbSymbols)) for i in range(size)]
+
 class Grid(object):
+	"""Grid of blocks stored column by column in a flat buffer.
+
+Cell (x, y) lives at index x*height + y, y = 0 being the top of the grid."""
 
-	def __init__(self, width=None, height=None, nbSymbols=5, data=None):
-		"""nbSymbols includes 0 (no block)"""
+	def __init__(self, width=None, height=None, nbSymbols=5, data=None, rng=None, bitboards=False, hashed=False):
+		"""nbSymbols includes 0 (no block)
+
+data is a list of columns, each one listing its blocks from top to bottom.
+rng is the random.Random instance used for generation, spawns and random
+swaps, the random module by default. If bitboards, the grid also keeps one
+bitboard per color (see enableBitboards). If hashed, it keeps its Zobrist hash
+(see enableHash)."""
+		self.rng = rng if rng != None else random
+		self._boards = None # Bitboard of each color, None if not kept
+		self._zobrist = None # Zobrist keys of each cell, None if the hash is not kept
 		if data:
 			assert len(data) >= 3 and len(data[0]) >= 3, 'grid too small!'
+			assert all(len(col) == len(data[0]) for col in data), 'columns must have the same height!'
 			self.width = len(data)
 			self.height = len(data[0])
 			self.nbSymbols = nbSymbols
-			self._grid = data
+			self._cells = array('b', (e for col in data for e in col))
+			self._initTracking()
 		else:
 			assert width >= 3 and height >= 3, 'grid too small!'
 			self.width = width
 			self.height = height
 			self.nbSymbols = nbSymbols
-			self._grid = [[0 for _ in range(self.height)] for _ in range(self.width)]
+			self._cells = array('b', bytes(width * height))
+			self._initTracking()
 			self.generate()
+		if bitboards: self.enableBitboards()
+		if hashed: self.enableHash()
+
+	def reset(self, seed=None):
+		"""Generate a new valid grid in the existing buffer.
+
+If seed is given, the grid generator is seeded with it first, so that the
+grid is the same as Grid(width, height, nbSymbols, rng=random.Random(seed))."""
+		assert not self._marks, 'cannot reset a grid during a transaction!'
+		if seed != None:
+			if isinstance(self.rng, random.Random): self.rng.seed(seed)
+			else: self.rng = random.Random(seed)
+		self._cells[:] = array('b', bytes(len(self._cells)))
+		self._log = None
+		self.generate()
+
+	def _initTracking(self):
+		"""Consider every cell as changed"""
+		self._dirty = set(range(self.width * self.height)) # Cells changed since last pendingCombos
+		self._log = None # Undo log of (index, old block, was dirty) during transactions
+		self._marks = [] # Undo log length at the beginning of each nested transaction
+		self._scanColumns()
+
+	def _scanColumns(self):
+		"""Compute the metadata of every column from the buffer"""
+		data, h = self._cells.tobytes(), self.height
+		self._top = [] # Topmost block of each column, height if none
+		self._gap = [] # Lowest void of each column, -1 if none
+		self._count = [] # Number of blocks of each column
+		for b in range(0, len(data), h):
+			column = data[b:b+h]
+			self._top.append(h - len(column.lstrip(b'\0')))
+			self._gap.append(column.rfind(0))
+			self._count.append(h - column.count(0))
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['_zobrist'] = self._zobrist != None # Keys are shared by the grids of the same size
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._zobrist = zobristKeys(self.width * self.height, self.nbSymbols) if self._zobrist else None
+
+	def enableHash(self):
+		"""Keep the Zobrist hash of the blocks in self.hash, updated in O(1) by every write.
+
+The hash xors a random key by cell and color, so that equal grids have equal
+hashes, and different ones almost never."""
+		if self._zobrist != None: return
+		self._zobrist = zobristKeys(self.width * self.height, self.nbSymbols)
+		self._scanHash()
+
+	def _scanHash(self):
+		"""Compute the Zobrist hash of the grid from the buffer"""
+		key = 0
+		for keys, block in zip(self._zobrist, self._cells):
+			key ^= keys[block]
+		self.hash = key
 
 	def __getitem__(self, pos):
-		if not hasattr(pos, '__getitem__'): return self._grid[pos]
-		return self._grid[pos[0]][pos[1]]
+		"""grid[x] is a read-only view of column x, grid[x, y] the block at (x, y)"""
+		if isinstance(pos, int):
+			if pos < 0: pos += self.width
+			if not 0 <= pos < self.width: raise IndexError('column index out of range')
+			return memoryview(self._cells).toreadonly()[pos*self.height:(pos+1)*self.height]
+		x, y = pos
+		if not (0 <= x < self.width and 0 <= y < self.height):
+			raise IndexError('position out of range: ' + str((x, y)))
+		return self._cells[x*self.height + y]
 
 	def __setitem__(self, pos, val):
-		if not hasattr(pos, '__getitem__'): self._grid[pos] = val
-		self._grid[pos[0]][pos[1]] = val
+		"""grid[x] = column replaces column x, grid[x, y] = block sets one block"""
+		if isinstance(pos, int):
+			assert len(val) == self.height, 'column must have the grid height!'
+			for y, v in enumerate(val):
+				self.setCell(pos, y, v)
+			return
+		x, y = pos
+		if not (0 <= x < self.width and 0 <= y < self.height):
+			raise IndexError('position out of range: ' + str((x, y)))
+		self.setCell(x, y, val)
+
+	def __iter__(self):
+		for x in range(self.width):
+			yield self[x]
+
+	def cell(self, x, y):
+		"""Return the block at (x, y), without bounds checking"""
+		return self._cells[x*self.height + y]
+
+	def setCell(self, x, y, val):
+		"""Set the block at (x, y), without bounds checking"""
+		self._put(x*self.height + y, val)
+
+	def _put(self, i, val):
+		"""Set the block at index i of the buffer and record the change"""
+		c = self._cells
+		old = c[i]
+		if old == val: return
+		c[i] = val
+		if self._log != None: self._log.append((i, old, i in self._dirty))
+		self._dirty.add(i)
+		if self._zobrist != None:
+			keys = self._zobrist[i]
+			self.hash ^= keys[old] ^ keys[val]
+		if self._boards != None:
+			boards, bit = self._boards, 1 << i
+			if old: boards[old] ^= bit
+			if val: boards[val] |= bit
+
+		if old and val: return # Column metadata only depends on voids
+		x, y = divmod(i, self.height)
+		b = i - y
+		if val: # Block added
+			self._count[x] += 1
+			if y < self._top[x]: self._top[x] = y
+			if y == self._gap[x]:
+				y -= 1
+				while y >= 0 and c[b+y]: y -= 1
+				self._gap[x] = y
+		else: # Block removed
+			self._count[x] -= 1
+			if y > self._gap[x]: self._gap[x] = y
+			if y == self._top[x]:
+				y += 1
+				while y < self.height and not c[b+y]: y += 1
+				self._top[x] = y
+
+	def begin(self):
+		"""Begin a transaction: every later write can be undone by rollback.
+
+Transactions can be nested. Writes are logged, so that rollback costs
+O(changes). reset and generate are not transactional."""
+		if self._log == None: self._log = []
+		self._marks.append(len(self._log))
+
+	def rollback(self):
+		"""Undo the writes of the current transaction and end it"""
+		mark, log = self._marks.pop(), self._log
+		self._log = None # Undo writes are not logged
+		while len(log) > mark:
+			i, old, wasDirty = log.pop()
+			if i < 0: # Changed cells consumed by pendingCombos
+				self._dirty = old
+				continue
+			self._put(i, old)
+			if not wasDirty: self._dirty.discard(i)
+		if self._marks: self._log = log
+
+	def commit(self):
+		"""End the current transaction, keeping its writes"""
+		self._marks.pop()
+		if not self._marks: self._log = None
+
+	@contextmanager
+	def trial(self):
+		"""Context manager running a transaction that is always rolled back"""
+		self.begin()
+		try:
+			yield self
+		finally:
+			self.rollback()
+
+	def blockCount(self, x=None):
+		"""Return the number of blocks of column x, or of the whole grid"""
+		return self._count[x] if x != None else sum(self._count)
+
+	def columnTop(self, x):
+		"""Return the topmost block row of column x, the grid height if it is empty"""
+		return self._top[x]
+
+	def row(self, y):
+		"""Return the blocks of row y as bytes"""
+		return self._cells[y::self.height].tobytes()
 
 	def __repr__(self):
 		return self.reprDigits()
 
 	def reprDigits(self, color=False):
 		"""Return a string represeting grid, with digits and colors"""
+		c, h = self._cells, self.height
 		if color:
-			return (RESET_COLOR + '\n').join(' '.join(fgcolors(self._grid[i][j]) + \
-			str(self._grid[i][j]) for i in range(self.width)) + ' '\
+			return (RESET_COLOR + '\n').join(' '.join(fgcolors(c[i*h+j]) + \
+			str(c[i*h+j]) for i in range(self.width)) + ' '\
 			for j in range(self.height)) + (RESET_COLOR + '\n')
-		else: return '\n'.join(' '.join(str(self._grid[i][j])\
+		else: return '\n'.join(' '.join(str(c[i*h+j])\
 			for i in range(self.width)) + ' ' for j in range(self.height)) + '\n'
 
 	def reprBlocks(self):
 		"""Return a string represeting grid, with colors blocks"""
-		return (RESET_COLOR + '\n').join(''.join(bgcolors(self._grid[i][j]) + '  '\
+		c, h = self._cells, self.height
+		return (RESET_COLOR + '\n').join(''.join(bgcolors(c[i*h+j]) + '  '\
 		for i in range(self.width)) for j in range(self.height)) + (RESET_COLOR + '\n')
 
 	def generate(self):
-		"""Generate a valid grid"""
+		"""Generate a valid grid.
+
+Each block is drawn among the colors that make no combo with the blocks below
+and on the left, so every draw is kept."""
+		c, h, rng = self._cells, self.height, self.rng
+		allowed, draw = allowedColors(self.nbSymbols), rng.random
 		for x in range(self.width):
-			for y in reversed(range(randrange(self.height) + 1, self.height)):
-				self._grid[x][y] = self.genDifferentBlock(x, y)
-
-	def genDifferentBlock(self, x:int, y:int):
-		"""Generate a random block based on neighbour blocks"""
-		rand = randrange(1, self.nbSymbols)
-		while (y <= self.height - 3 and self[x][y+1] == self[x][y+2] == rand) \
-		or (x >= 2 and self[x-1][y] == self[x-2][y] == rand):
-			rand = randrange(1, self.nbSymbols)
-		return rand
-		
+			b = x*h
+			for i in reversed(range(b + rng.randrange(h) + 1, b + h)):
+				below = c[i+1] if i+2 < b+h and c[i+1] == c[i+2] else 0
+				left = c[i-h] if x >= 2 and c[i-h] == c[i-2*h] else 0
+				colors = allowed[below][left]
+				c[i] = colors[int(draw() * len(colors))]
+		self._dirty.clear() # A generated grid has no combo
+		self._scanColumns()
+		if self._zobrist != None: self._scanHash()
+		if self._boards != None: self._scanBitboards()
+
+	@classmethod
+	def generateMany(cls, count, width, height, nbSymbols=5, seed=None):
+		"""Return count valid grids generated from seed.
+
+Grid k has its own generator, seeded by the k-th draw of the seed one, so
+that it can be regenerated alone."""
+		rng = random.Random(seed)
+		return [cls(width, height, nbSymbols, rng=random.Random(rng.getrandbits(64)))
+			for _ in range(count)]
+
 	def spawnBlock(self):
 		"""Spawn a block at the top of the grid"""
-		self[randrange(0, self.width)][0] = randrange(0, self.nbSymbols)
+		color = self.rng.randrange(0, self.nbSymbols)
+		self.setCell(self.rng.randrange(0, self.width), 0, color)
 
 	def swap(self, x:int, y:int):
 		"""Swap two blocks horizontally"""
-		self[x][y], self[x+1][y] = self[x+1][y], self[x][y]
+		i = x*self.height + y
+		j = i + self.height
+		a, b = self._cells[i], self._cells[j]
+		self._put(i, b)
+		self._put(j, a)
 
 	def isHole(self, x, y):
-		return self[x][y] == 0 and any(self[x][j] != 0 for j in range(y))
+		return self._cells[x*self.height + y] == 0 and self._top[x] < y
 
 	def fallStepPos(self, x, y):
 		"""Make blocks above pos fall one step"""
-		for j in reversed(range(y)):
-			self[x][j+1] = self[x][j]
-		self[x][j] = 0
+		c, put = self._cells, self._put
+		b, top = x*self.height, self._top[x]
+		for i in range(b+y, b + max(top, 1) - 1, -1): # Voids above the top stay
+			put(i, c[i-1])
+		if top == 0: put(b, 0)
 
 	def fallInstant(self, focusX=None):
-		"""Make blocks fall instantly."""
+		"""Make blocks fall instantly, compacting each column in one pass."""
+		c, h, put = self._cells, self.height, self._put
 		for x in (focusX if focusX != None else range(self.width)):
-			for y in reversed(range(self.height)):
-				while self.isHole(x, y):
-					self.fallStepPos(x, y)
+			if self._top[x] > self._gap[x]: continue # No hole
+			b = x*h
+			blocks = c[b:b+h].tobytes().replace(b'\0', b'')
+			for y, block in enumerate(bytes(h - len(blocks)) + blocks, b):
+				put(y, block)
 
 	def fallStep(self, focusX=None):
 		"""Make blocks fall one step, return whether it was the last step of fall"""
 		isLastStep = True
-		for x in (focusX if focusX != None else range(self.width)):
-			for y in reversed(range(self.height)):
-				if self.isHole(x, y):
-					self.fallStepPos(x, y)
-					if any(self[x][j] != 0 for j in range(y)):
-						isLastStep = False
-					break
+		for x, y in self.lowerHoles(focusX):
+			self.fallStepPos(x, y)
+			if self._top[x] < y:
+				isLastStep = False
 		return isLastStep
 
 	def lowerHoles(self, focusX=None):
-		holes = []
-		for x in (focusX if focusX != None else range(self.width)):
-			for y in reversed(range(self.height)):
-				if self.isHole(x, y):
-					holes.append((x, y))
-				if self[x][y] == 0: break # Break at any void in column
-		return holes
+		"""Return the lowest hole of each column having one"""
+		top, gap = self._top, self._gap
+		return [(x, gap[x]) for x in (focusX if focusX != None else range(self.width)) if top[x] < gap[x]]
 
 	def combosLine(self, y):
 		"""Look for combos in line and return them"""
-		comboGroup = []
-		comboCount = 1
-
-		#DEBUG('line:', [self[i][y] for i in range(self.width)])
-		# Iterate through line
-		for x in range(self.width):
-			ref = self[x][y]
-			#DEBUG('({},{}) ref {} xcombo {}'.format(x, y, ref, comboCount))
-			if ref != 0 and x >= 1 and ref == self[x-1][y]:
-				comboCount += 1
-			if self[x-1][y] != ref:
-				if comboCount >= 3:
-					combo = Combo([(i, y) for i in range(x-comboCount, x)], self[x-1][y])
-					comboGroup.append(combo)
-				comboCount = 1
-			if x == self.width - 1 and comboCount >= 3:
-				combo = Combo([(i, y) for i in range(x-comboCount+1, x+1)], ref)
-				comboGroup.append(combo)
-		return comboGroup
+		return [Combo.fromRun(x, y, length, 'h', color)
+			for x, length, color in scanRuns(self._cells[y::self.height].tobytes())]
 
 	def combosColumn(self, x):
 		"""Look for combos in column and return them"""
-		comboGroup = []
-		comboCount = 1
-
-		#DEBUG('column:', [self[x][j] for j in range(self.height)])
-		# Iterate through column
-		for y in range(self.height):
-			ref = self[x][y]
-			#DEBUG('({},{}) ref {} ycombo {}'.format(x, y, ref, comboCount))
-			if ref != 0 and y >= 1 and ref == self[x][y-1]:
-				comboCount += 1
-			if ref != self[x][y-1]:
-				if comboCount >= 3:
-					combo = Combo([(x, j) for j in range(y-comboCount, y)], self[x][y-1])
-					comboGroup.append(combo)
-				comboCount = 1
-			if y == self.height - 1 and comboCount >= 3:
-				combo = Combo([(x, j) for j in range(y-comboCount+1, y+1)], ref)
-				comboGroup.append(combo)
-		return comboGroup
+		h = self.height
+		return [Combo.fromRun(x, y, length, 'v', color)
+			for y, length, color in scanRuns(self._cells[x*h:(x+1)*h].tobytes())]
 
 	def combosAll(self):
 		"""Return the list of combos found in the whole grid"""
+		if self._boards != None and not self.hasCombo(): return []
+		return [Combo.fromRun(*run) for run in self.runs()]
+
+	def runs(self, minLen=3):
+		"""Return the run table of the whole grid, without building combos.
+
+Each run is a (x, y, length, orientation, color) tuple, (x, y) being its top
+or left block. Vertical runs come first, by column, then horizontal runs, by
+line. Both scans are done by the regex engine over the flat buffer."""
+		w, h = self.width, self.height
+		table = []
+
+		# Columns are contiguous in the buffer, runs overflowing a column are cut
+		for start, length, color in scanRuns(self._cells.tobytes(), minLen):
+			x, y = divmod(start, h)
+			while length > 0:
+				pieceLen = min(length, h - y)
+				if pieceLen >= minLen:
+					table.append((x, y, pieceLen, 'v', color))
+				x, y, length = x + 1, 0, length - pieceLen
+
+		# Lines are gathered in one buffer, separated by a void
+		lines = b'\0'.join(self._cells[y::h].tobytes() for y in range(h))
+		for start, length, color in scanRuns(lines, minLen):
+			y, x = divmod(start, w + 1)
+			table.append((x, y, length, 'h', color))
+
+		return table
+
+	def enableBitboards(self):
+		"""Keep one bitboard per color in sync with the buffer.
+
+The bitboard of a color is an int whose bit x*height + y is set when the
+block at (x, y) has this color, so a shift by height moves one column and a
+shift by 1 one row, masks keeping vertical patterns within a column. Combo
+tests then work on the whole grid in a few int operations."""
+		if self._boards != None: return
+		w, h = self.width, self.height
+		self._full = (1 << w*h) - 1
+		columns = self._full // ((1 << h) - 1) # Bit of row 0 of every column
+		rows = lambda first, last: ((1 << last + 1) - (1 << first)) * columns # Rows first to last
+		self._rowMasks = (rows(0, h-3), rows(1, h-2), rows(2, h-1)) # Rows starting, centering, ending a vertical run
+		self._scanBitboards()
+
+	def hasBitboards(self):
+		return self._boards != None
+
+	def _scanBitboards(self):
+		"""Compute the bitboard of every color from the buffer"""
+		data = self._cells.tobytes()[::-1] # Highest bit first
+		self._boards = [int(data.translate(bytes(48 + (c == color) for c in range(256))), 2)
+			for color in range(self.nbSymbols)]
+		self._boards[0] = 0 # Voids have no bitboard
+
+	def bitboard(self, color):
+		"""Return the bitboard of color, the bitboards being enabled"""
+		return self._boards[color]
+
+	def hasCombo(self):
+		"""Return whether the grid has a combo, using the bitboards"""
+		h, top = self.height, self._rowMasks[0]
+		for b in self._boards:
+			if b & (b >> h) & (b >> 2*h) or b & (b >> 1) & (b >> 2) & top: return True
+		return False
+
+	def comboSwapMask(self):
+		"""Return the bitboard of the swap positions making a combo, using the bitboards.
+
+A swap makes a combo when a block moved one column aligns with two blocks
+of its color, none of them the block it was swapped with. Swaps moving a block
+above a void are included, although the block falls."""
+		h, full = self.height, self._full
+		top, mid, bottom = self._rowMasks
+		mask = 0
+		for b in self._boards:
+			if not b: continue
+			other = full & ~b
+			# Block of b at p moving right, to q = p + h, patterns relative to p
+			toRight = b & (other >> h) & ((b >> 2*h) & (b >> 3*h)
+				| (b >> h-1) & (b >> h-2) & bottom
+				| (b >> h-1) & (b >> h+1) & mid
+				| (b >> h+1) & (b >> h+2) & top)
+			# Block of b at p moving left, to q = p - h
+			toLeft = b & (other << h) & ((b << 2*h) & (b << 3*h)
+				| (b << h+1) & (b << h+2) & bottom
+				| (b << h+1) & (b << h-1) & mid
+				| (b << h-1) & (b << h-2) & top)
+			mask |= toRight | toLeft >> h
+		return mask
+
+	def comboSwaps(self):
+		"""Return the positions of the swaps making a combo, by column then row"""
+		mask, h = self.comboSwapMask(), self.height
+		swaps = []
+		while mask:
+			low = mask & -mask
+			swaps.append(divmod(low.bit_length() - 1, h))
+			mask ^= low
+		return swaps
+
+	def hasComboSwap(self):
+		"""Return whether a swap makes a combo, using the bitboards"""
+		return bool(self.comboSwapMask())
+
+	def clearChanges(self):
+		"""Forget the changed cells, and return their indices"""
+		dirty = self._dirty
+		self._dirty = set()
+		if self._log != None: self._log.append((-1, dirty, None))
+		return dirty
+
+	def pendingCombos(self):
+		"""Return the combos including at least one block changed since last call,
+or since clearChanges.
+
+Only lines and columns touching changed cells are scanned."""
+		dirty, h = self.clearChanges(), self.height
 		comboGroup = []
 
-		for x in range(self.width):
-			comboGroup.extend(self.combosColumn(x))
+		for x in sorted({i // h for i in dirty}):
+			b = x*h
+			for y, length, color in scanRuns(self._cells[b:b+h].tobytes()):
+				if any(i in dirty for i in range(b+y, b+y+length)):
+					comboGroup.append(Combo.fromRun(x, y, length, 'v', color))
 
-		for y in range(self.height):
-			comboGroup.extend(self.combosLine(y))
+		for y in sorted({i % h for i in dirty}):
+			for x, length, color in scanRuns(self._cells[y::h].tobytes()):
+				if any(i in dirty for i in range(x*h+y, (x+length)*h+y, h)):
+					comboGroup.append(Combo.fromRun(x, y, length, 'h', color))
 
 		return comboGroup
 
+	def resolveInstant(self, multiplier=1, changed=None):
+		"""Make blocks fall and destroy combos until the grid is stable, instantly.
+
+The first step destroys every combo of the grid, or only those including a
+block moved by the falls or at one of the changed positions, if given. Later
+steps only look around the blocks moved or destroyed meanwhile.
+
+Return the chain steps as (combo group, score) tuples. As in Game.processCombos,
+the score of a step is scoreIt of its number of blocks times the multiplier,
+which increases by one at each step."""
+		h = self.height
+		self.clearChanges()
+		if changed == None: self._dirty = set(range(self.width * h))
+		else: self._dirty = {x*h + y for x, y in changed}
+		steps = []
+		while True:
+			self.fallInstant()
+			comboGroup = self.pendingCombos()
+			if not comboGroup: return steps
+			comboGroupPos = groupPositions(comboGroup)
+			steps.append((comboGroup, scoreIt(len(comboGroupPos)) * multiplier))
+			multiplier += 1
+			for x, y in comboGroupPos: # Remove combos
+				self.setCell(x, y, 0)
+
 	def blockRangeVerticalAround(self, x, y):
 		"""Return the range corresponding to the group of blocks around (x, y).
 
 Return a void range if there is no block at (x, y).
 """
-		return range(y+1 - indexFalse(self._grid[x][y::-1]),
-			y + indexFalse(self._grid[x][y:]))
+		c, b, h = self._cells, x*self.height, self.height
+		if not c[b+y]: return range(y, y)
+		top, bottom = y, y + 1
+		while top > 0 and c[b+top-1]: top -= 1
+		while bottom < h and c[b+bottom]: bottom += 1
+		return range(top, bottom)
 
 	def comboHorizontalAround(self, x, y, minLen=3):
 
-		f = lambda e: bool(e) and e == self._grid[x][y]
-		p1 = (e[y] for e in self._grid[x::-1])
-		p2 = (e[y] for e in self._grid[x:])
-		comboRange = range(x+1 - indexFalse(p1, f), x + indexFalse(p2, f))
-		if len(comboRange) >= minLen:
-			return Combo([(i, y) for i in comboRange], self._grid[x][y])
+		c, h = self._cells, self.height
+		color = c[x*h+y]
+		if not color: return None
+		left, right = x, x + 1
+		while left > 0 and c[(left-1)*h+y] == color: left -= 1
+		while right < self.width and c[right*h+y] == color: right += 1
+		if right - left >= minLen:
+			return Combo.fromRun(left, y, right - left, 'h', color)
 		return None
 
 	def comboVerticalAround(self, x, y, minLen=3):
 
-		f = lambda e: bool(e) and e == self._grid[x][y]
-		p1 = self._grid[x][y::-1]
-		p2 = self._grid[x][y:]
-		comboRange = range(y+1 - indexFalse(p1, f), y + indexFalse(p2, f))
-		if len(comboRange) >= minLen:
-			return Combo([(x, j) for j in comboRange], self._grid[x][y])
+		c, b, h = self._cells, x*self.height, self.height
+		color = c[b+y]
+		if not color: return None
+		top, bottom = y, y + 1
+		while top > 0 and c[b+top-1] == color: top -= 1
+		while bottom < h and c[b+bottom] == color: bottom += 1
+		if bottom - top >= minLen:
+			return Combo.fromRun(x, top, bottom - top, 'v', color)
 		return None
 
 	def combosAfterSwap(self, pos):
@@ -226,36 +585,130 @@ Return the list of combos found"""
 				yield self.comboHorizontalAround(x, j)
 
 		r = list(filter(None, blocksAroundHole()))
-		DEBUG("Combo after fall: %s %s", self.blockRangeVerticalAround(x, y), r)
+		DEBUG("Combo after fall: %s %s", Lazy(self.blockRangeVerticalAround, x, y), r)
 		return r
 
-	def randomBlock(self):
-		totalBlockNb = sum(block != 0 for col in self for block in col)
-		chosenBlock = randrange(totalBlockNb)
-		curBlock = -1
-		for x in range(self.width):
-			for y in range(self.height):
-				if self[x][y] != 0:
-					curBlock += 1
-				if curBlock == chosenBlock:
+	def combosAfterFalls(self, formerHoles):
+		"""Look for combos around several former holes at once.
+Return the list of combos found, each one once"""
+		combos = []
+		found = set() # Positions of the horizontal combos found
+		for x, y in formerHoles:
+			combo = self.comboVerticalAround(x, y)
+			if combo: combos.append(combo)
+			for j in self.blockRangeVerticalAround(x, y):
+				if (x, j) in found: continue
+				combo = self.comboHorizontalAround(x, j)
+				if combo:
+					combos.append(combo)
+					found.update(combo.positions())
+		return combos
+
+	def randomBlock(self, rng=None):
+		"""Return the position of a random block, drawn from rng or the grid one"""
+		c, h = self._cells, self.height
+		chosenBlock = (rng or self.rng).randrange(self.blockCount())
+		for x, count in enumerate(self._count):
+			if chosenBlock < count: break
+			chosenBlock -= count
+		for y in range(self._top[x], h):
+			if c[x*h+y] != 0:
+				if chosenBlock == 0:
 					return (x, y)
+				chosenBlock -= 1
 
-	def randomSwap(self):
-		randX, randY = self.randomBlock()
+	def randomSwap(self, rng=None):
+		randX, randY = self.randomBlock(rng)
 		if randX == 0: return (randX, randY)
 		if randX == self.width - 1: return (randX - 1, randY)
-		return (randX - randrange(2), randY)
+		return (randX - (rng or self.rng).randrange(2), randY)
+
+class GridPool(object):
+	"""Grids of one size, generated ahead of use and reused.
+
+prepare(seed) has a grid generated from seed, at once or by a background
+thread. get(seed) then hands it out, or generates it if it was not
+prepared. release gives back a grid that is no longer used: it is
+regenerated in place for a later seed instead of allocating a new one.
+
+Grids are expected to be asked for in the order they were prepared: get(seed)
+recycles the grids prepared before seed, as they will not be asked for
+anymore. A seed that was not prepared recycles none, since the grids ready
+may be for the next seeds."""
+
+	def __init__(self, width, height, nbSymbols=5, background=False):
+		self.size = (width, height, nbSymbols)
+		self._ready = {} # Generated grids by seed
+		self._pending = set() # Seeds of the grids being generated
+		self._spares = [] # Released grids
+		self._cond = threading.Condition()
+		self._todo = None # Seeds to generate, by the background thread
+		self.hits = self.misses = 0 # Number of get calls finding their grid prepared, or not
+		if background:
+			self._todo = queue.SimpleQueue()
+			threading.Thread(target=self._fill, name='GridPool', daemon=True).start()
+
+	def _generate(self, seed):
+		with self._cond:
+			grid = self._spares.pop() if self._spares else None
+		if grid == None: return Grid(*self.size, rng=random.Random(seed))
+		grid.reset(seed)
+		return grid
+
+	def _fill(self):
+		while True:
+			seed = self._todo.get()
+			grid = self._generate(seed)
+			with self._cond:
+				self._ready[seed] = grid
+				self._pending.discard(seed)
+				self._cond.notify_all()
+
+	def prepare(self, seed):
+		"""Have the grid of seed generated before it is asked for"""
+		with self._cond:
+			if seed in self._ready or seed in self._pending: return
+			if self._todo != None:
+				self._pending.add(seed)
+				self._todo.put(seed)
+				return
+		grid = self._generate(seed)
+		with self._cond:
+			self._ready[seed] = grid
+
+	def get(self, seed):
+		"""Return the grid generated from seed, waiting for it if it is being prepared"""
+		with self._cond:
+			while seed in self._pending:
+				self._cond.wait()
+			if seed in self._ready:
+				self.hits += 1
+				for stale in list(self._ready): # Prepared before seed
+					if stale == seed: break
+					self._spares.append(self._ready.pop(stale))
+				return self._ready.pop(seed)
+			self.misses += 1
+		return self._generate(seed)
+
+	def release(self, grid):
+		"""Give back a grid for reuse"""
+		assert (grid.width, grid.height, grid.nbSymbols) == self.size, 'grid of another size!'
+		with self._cond:
+			self._spares.append(grid)
 
 class Block(Sequence):
 	"""A tuple-like"""
+	__slots__ = ('pos', 'color')
+
 	def __init__(self, pos, color):
 		self.pos = pos
 		self.color = color
 
 	def __len__(self): return len(self.pos)
 	def __getitem__(self, i): return self.pos[i]
+	def __iter__(self): return iter(self.pos)
 
-	def __eq__(self, other): return self.pos == other.pos and self.color == other.color
+	def __eq__(self, other): return isinstance(other, Block) and self.pos == other.pos and self.color == other.color
 	def __hash__(self): return hash(self.pos)
 	def __repr__(self):
 		#return str(self.pos)
@@ -263,39 +716,91 @@ class Block(Sequence):
 	def __str__(self): return str(self.pos)
 
 class Combo(MutableSequence):
-	"""A list-like"""
+	"""A list-like of blocks of the same color.
+
+A combo built from a run is stored as (x, y, length, orientation, color), and
+its Block objects are only built when they are accessed. Any modification
+turns it into a plain list of blocks, length being None from then on."""
+	__slots__ = ('x', 'y', 'length', '_orientation', 'color', '_blocks')
+
+	@classmethod
+	def fromRun(cls, x, y, length, orientation, color):
+		"""Build the combo of a run, as listed by Grid.runs"""
+		self = cls.__new__(cls)
+		self.x, self.y, self.length, self._orientation, self.color = x, y, length, orientation, color
+		self._blocks = None
+		return self
 
 	def __init__(self, blockList, color=None):
 		assert isinstance(blockList, Sequence) and len(blockList) > 0, "blockList must be a non-empty sequence"
 		if color != None and color > 0:
-			self.blockList = [Block(e, color) for e in blockList]
+			self._blocks = [Block(tuple(e), color) for e in blockList]
 			self.color = color
 		else:
 			assert all(isinstance(e, Block) for e in blockList), "if no color argument provided, blockList must be a sequence of Block objects"
-			self.blockList = blockList[:]
+			self._blocks = list(blockList)
 			self.color = blockList[0].color
-
-	def __len__(self): return len(self.blockList)
+		self.x, self.y = self._blocks[0].pos
+		self.length = self._orientation = None
+
+	@property
+	def blockList(self):
+		if self._blocks == None:
+			self._blocks = [Block(pos, self.color) for pos in self.positions()]
+		return self._blocks
+
+	def _modified(self):
+		self.length = self._orientation = None
+
+	def positions(self):
+		"""Return the list of the block positions, without building blocks"""
+		if self.length == None: return [b.pos for b in self._blocks]
+		x, y = self.x, self.y
+		if self._orientation == 'v': return [(x, j) for j in range(y, y + self.length)]
+		return [(i, y) for i in range(x, x + self.length)]
+
+	def __len__(self): return self.length if self.length != None else len(self._blocks)
 	def __getitem__(self, i): return self.blockList[i]
-	def __setitem__(self, i, v): self.blockList[i] = v
-	def __delitem__(self, i): del self.blockList[i]
-	def __iadd__(self, e): self.blockList += e
-	def append(self, e): self.blockList.append(e)
-	def insert(self, i, e): self.blockList.insert(i, e)
+	def __setitem__(self, i, v): self.blockList[i] = v; self._modified()
+	def __delitem__(self, i): del self.blockList[i]; self._modified()
+	def __iadd__(self, e): self.blockList.extend(e); self._modified(); return self
+	def append(self, e): self.blockList.append(e); self._modified()
+	def insert(self, i, e): self.blockList.insert(i, e); self._modified()
+
+	def __contains__(self, block):
+		"""Whether a block, or a plain position, is in the combo"""
+		if getattr(block, 'color', self.color) != self.color: return False
+		if self.length == None: return tuple(block) in self.positions()
+		x, y = block
+		if self._orientation == 'v': return x == self.x and 0 <= y - self.y < self.length
+		return y == self.y and 0 <= x - self.x < self.length
 
 	def __eq__(self, other):
-		return isinstance(other, Combo) and self.blockList == other.blockList and self.color == other.color
+		if not isinstance(other, Combo): return False
+		if self.length != None and other.length != None:
+			return (self.x, self.y, self.length, self._orientation, self.color) == \
+				(other.x, other.y, other.length, other._orientation, other.color)
+		return self.blockList == other.blockList and self.color == other.color
 	def __repr__(self):
 		orientation = self.orientation()
-		ref = self.blockList[0]
+		positions = self.positions()
 		if orientation == 'v':
-			return "C{}({},[{}])".format(self.color, ref[0], ','.join(str(e[1]) for e in self.blockList))
+			return "C{}({},[{}])".format(self.color, self.x, ','.join(str(e[1]) for e in positions))
 		if orientation == 'h':
-			return "C{}([{}],{})".format(self.color, ','.join(str(e[0]) for e in self.blockList), ref[1])
-		return "C{}[{}]".format(self.color, ','.join(str(b) for b in self.blockList))
+			return "C{}([{}],{})".format(self.color, ','.join(str(e[0]) for e in positions), self.y)
+		return "C{}[{}]".format(self.color, ','.join(str(pos) for pos in positions))
 
 	def orientation(self):
-		ref = self.blockList[0]
-		if all(e[0] == ref[0] for e in self.blockList[1:]): return 'v'
-		if all(e[1] == ref[1] for e in self.blockList[1:]): return 'h'
-		return '?'
+		if self._orientation == None:
+			positions = self.positions()
+			ref = positions[0]
+			if all(e[0] == ref[0] for e in positions[1:]): self._orientation = 'v'
+			elif all(e[1] == ref[1] for e in positions[1:]): self._orientation = 'h'
+			else: self._orientation = '?'
+		return self._orientation
+
+def groupPositions(comboGroup):
+	"""Return the set of positions of the blocks of a combo group"""
+	return set(flatten(combo.positions() for combo in comboGroup))
+
+profile(Grid, 'lowerHoles', 'combosAfterSwap', 'combosAfterFall', 'combosAfterFalls')
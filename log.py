@@ -1,29 +1,175 @@
 
-"""Log utilities"""
+"""Log utilities
 
-from time import time, strftime
+Nothing is logged until configure is called. Until then, the log functions
+return at once, before any formatting. Arguments are only formatted when the
+message is written: wrap costly ones with Lazy.
+
+Profiling: modules register their hot methods with profile. Between
+startProfiling and stopProfiling, those methods are wrapped by timeit, which
+records their durations in timers. report formats them."""
+
+import atexit
+import queue
 import logging
-logging.basicConfig(filename='swap.log', filemode='w', level=logging.DEBUG, \
-format='%(message)s')
-logger = logging.getLogger(__name__)
+import logging.handlers
+from time import perf_counter_ns
+from collections import Counter
+
+logger = logging.getLogger('swap')
 logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+# Whether each level is logged, resolved by configure
+_debug = _info = _warn = _error = False
+_listener = None # Thread writing queued records
+
+def configure(filename='swap.log', level=logging.DEBUG, queued=True):
+	"""Log the messages of at least level to filename.
+
+If queued, records are written by a background thread, so that logging from
+the game loop never waits for the disk."""
+	global _debug, _info, _warn, _error, _listener
+	shutdown()
+	for handler in logger.handlers[:]:
+		logger.removeHandler(handler)
+		handler.close()
+
+	handler = logging.FileHandler(filename, 'w')
+	handler.setFormatter(logging.Formatter('%(message)s'))
+	if queued:
+		records = queue.SimpleQueue()
+		_listener = logging.handlers.QueueListener(records, handler)
+		_listener.start()
+		handler = logging.handlers.QueueHandler(records)
+	logger.addHandler(handler)
+	logger.setLevel(level)
+
+	_debug = level <= logging.DEBUG
+	_info = level <= logging.INFO
+	_warn = level <= logging.WARNING
+	_error = level <= logging.ERROR
+
+def shutdown():
+	"""Write the queued records, stop the background thread and close its file"""
+	global _listener
+	if _listener:
+		_listener.stop()
+		for handler in _listener.handlers:
+			handler.close()
+		_listener = None
+
+atexit.register(shutdown)
+
+def DEBUG(msg, *args):
+	if _debug: logger.debug(msg, *args)
+def INFO(msg, *args):
+	if _info: logger.info(msg, *args)
+def WARN(msg, *args):
+	if _warn: logger.warning(msg, *args)
+def ERROR(msg, *args):
+	if _error: logger.error(msg, *args)
+
+class Lazy(object):
+	"""Log argument computed by func(*args), only when the message is written"""
+	__slots__ = ('func', 'args')
+
+	def __init__(self, func, *args):
+		self.func = func
+		self.args = args
+
+	def __str__(self): return str(self.func(*self.args))
+	def __repr__(self): return repr(self.func(*self.args))
+
+
+class Timer(object):
+	"""Number of calls, total duration and histogram of the durations of a function.
+
+Durations, in nanoseconds, are bucketed by their 3 most significant bits, so
+percentiles are exact within 25%."""
+	__slots__ = ('name', 'calls', 'total', 'buckets')
+
+	def __init__(self, name):
+		self.name = name
+		self.reset()
+
+	def reset(self):
+		self.calls = 0
+		self.total = 0
+		self.buckets = Counter() # Number of durations by bucket lower bound
+
+	def add(self, ns):
+		self.calls += 1
+		self.total += ns
+		shift = max(0, ns.bit_length() - 3)
+		self.buckets[ns >> shift << shift] += 1
+
+	def percentile(self, p):
+		"""Return the bucket of the duration below which p% of the calls lasted"""
+		rank = p * self.calls / 100
+		seen = 0
+		for bucket in sorted(self.buckets):
+			seen += self.buckets[bucket]
+			if seen >= rank: return bucket
+		return 0
+
+timers = {} # Timer by function name
+_profiled = [] # (owner, attribute name) of the functions to profile
+_originals = {} # Original function by (owner, attribute name), while profiling
+
+def timeit(method, name=None):
+	"""Return method wrapped to record the duration of its calls in timers[name]"""
+	name = name or method.__qualname__
+	if name not in timers: timers[name] = Timer(name)
+	timer = timers[name]
+
+	def timed(*args, **kwargs):
+		t = perf_counter_ns()
+		try:
+			return method(*args, **kwargs)
+		finally:
+			timer.add(perf_counter_ns() - t)
+
+	timed.__wrapped__ = method
+	return timed
+
+def profile(owner, *names):
+	"""Register methods of class owner to be timed while profiling.
+
+Methods are only wrapped while profiling, so they cost nothing otherwise."""
+	for name in names:
+		_profiled.append((owner, name))
+		if _originals: _wrap(owner, name)
 
-def timestamp():
-	return ''#strftime('%H:%M:%S') + "." + str(time()).split('.')[1][:2]
-def DEBUG(msg, *args): logger.debug(timestamp() + " " + msg, *args)
-def INFO(msg, *args): logger.info(timestamp() + " " + msg, *args)
-def WARN(msg, *args): logger.warning(timestamp() + " " + msg, *args)
-def ERROR(msg, *args): logger.error(timestamp() + " " + msg, *args)
+def _wrap(owner, name):
+	method = owner.__dict__[name]
+	_originals[owner, name] = method
+	setattr(owner, name, timeit(method, '{}.{}'.format(owner.__name__, name)))
 
+def isProfiling():
+	return bool(_originals)
 
-def timeit(method):
+def startProfiling():
+	if _originals: return
+	for owner, name in _profiled:
+		_wrap(owner, name)
 
-    def timed(*args, **kwargs):
-        t = time()
-        result = method(*args, **kwargs)
-        dt = time() - t
+def stopProfiling():
+	for (owner, name), method in _originals.items():
+		setattr(owner, name, method)
+	_originals.clear()
 
-        DEBUG('%s %.3fs' % (method.__name__, dt))
-        return result
+def resetTimers():
+	for timer in timers.values():
+		timer.reset()
 
-    return timed
+def report():
+	"""Return a table of the timed functions, by decreasing total duration"""
+	lines = ['{:<28} {:>9} {:>10} {:>9} {:>9} {:>9}'.format(
+		'function', 'calls', 'total ms', 'mean us', 'p50 us', 'p99 us')]
+	for timer in sorted(timers.values(), key=lambda timer: -timer.total):
+		if not timer.calls: continue
+		lines.append('{:<28} {:>9} {:>10.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(timer.name,
+			timer.calls, timer.total / 1e6, timer.total / timer.calls / 1e3,
+			timer.percentile(50) / 1e3, timer.percentile(99) / 1e3))
+	return '\n'.join(lines)
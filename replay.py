@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: Utf-8 -*-
+
+"""Replays of Swap
+
+A game is deterministic given its seed, so a replay only stores the seed, the
+players, and the tick-stamped inputs and AI swaps. AI swaps are recorded since
+an AI searching on the wall clock is not deterministic.
+
+Format: the magic string, the seed, the number of players, then the type and
+the name of each player. Each event follows as the number of ticks since the
+previous event and a code:
+- 0 to 4: input (see INPUTS),
+- AI_SWAP + player index, followed by x and y,
+- END, followed by the score of each player.
+Integers are varints: 7 bits per byte, lowest first, the high bit set on every
+byte but the last.
+
+Playback re-simulates the game as fast as possible. It snapshots the game every
+KEYFRAME_INTERVAL ticks, so seeking back restarts from the closest keyframe.
+
+usage: replay.py FILE [--time SECONDS]
+"""
+
+import sys
+import pickle
+import argparse
+from bisect import bisect_right
+from time import perf_counter
+
+from swap import Game, Player
+
+
+MAGIC = b'SWAPRPL\x01'
+PLAYER_TYPES = ('Human', 'AI')
+INPUTS = ('up', 'right', 'down', 'left', 'swap')
+AI_SWAP = 0x10 # Code of the AI swaps of the first player
+END = 0xff
+
+class ReplayError(Exception):
+	pass
+
+def writeVarint(out, n):
+	while n > 0x7f:
+		out.append(n & 0x7f | 0x80)
+		n >>= 7
+	out.append(n)
+
+def readVarint(data, i):
+	"""Return the varint at data[i] and the index following it"""
+	n = shift = 0
+	while True:
+		byte = data[i]
+		i += 1
+		n |= (byte & 0x7f) << shift
+		if byte < 0x80: return n, i
+		shift += 7
+
+class Recorder(object):
+	"""Record a game into a replay file, from its first tick"""
+
+	def __init__(self, game, file):
+		assert game.tickCount == 0, 'A replay must be recorded from the start of the game'
+		self.game = game
+		self.ownFile = isinstance(file, str)
+		self.file = open(file, 'wb') if self.ownFile else file
+		self.lastTick = 0
+
+		out = bytearray(MAGIC)
+		writeVarint(out, game.seed)
+		writeVarint(out, len(game.players))
+		for player in game.players:
+			name = player.name.encode('utf-8')
+			out.append(PLAYER_TYPES.index(player.type))
+			writeVarint(out, len(name))
+			out += name
+		self.file.write(out)
+		game.recorder = self
+
+	def event(self, code):
+		out = bytearray()
+		writeVarint(out, self.game.tickCount - self.lastTick)
+		out.append(code)
+		self.lastTick = self.game.tickCount
+		return out
+
+	def input(self, name):
+		self.file.write(self.event(INPUTS.index(name)))
+
+	def aiSwap(self, player):
+		out = self.event(AI_SWAP + self.game.players.index(player))
+		for e in player.swapperPos: writeVarint(out, e)
+		self.file.write(out)
+
+	def close(self):
+		"""End the replay with the final scores, which playback checks"""
+		out = self.event(END)
+		for player in self.game.players: writeVarint(out, player.score)
+		self.file.write(out)
+		if self.ownFile: self.file.close()
+		else: self.file.flush()
+		self.game.recorder = None
+
+class Playback(object):
+	"""Replay a recorded game, whose state is self.game"""
+	KEYFRAME_INTERVAL = 400 # Number of ticks between keyframes
+
+	def __init__(self, file):
+		if isinstance(file, str):
+			with open(file, 'rb') as f: data = f.read()
+		else: data = file.read()
+		if not data.startswith(MAGIC): raise ReplayError('Not a replay')
+
+		i = len(MAGIC)
+		seed, i = readVarint(data, i)
+		nbPlayers, i = readVarint(data, i)
+		players = []
+		for _ in range(nbPlayers):
+			type_ = PLAYER_TYPES[data[i]]
+			length, i = readVarint(data, i+1)
+			players.append(Player(type_, data[i:i+length].decode('utf-8')))
+			i += length
+
+		self.inputs = [] # (tick, name)
+		self.aiSwaps = [[] for _ in players] # (tick, position) by player
+		self.scores = None # Final scores, None if the replay is truncated
+		tick = 0
+		try:
+			while i < len(data):
+				delta, i = readVarint(data, i)
+				tick += delta
+				code = data[i]
+				i += 1
+				if code < len(INPUTS):
+					self.inputs.append((tick, INPUTS[code]))
+				elif code == END:
+					self.scores = []
+					for _ in players:
+						score, i = readVarint(data, i)
+						self.scores.append(score)
+					break
+				elif AI_SWAP <= code < AI_SWAP + nbPlayers:
+					x, i = readVarint(data, i)
+					y, i = readVarint(data, i)
+					self.aiSwaps[code - AI_SWAP].append((tick, (x, y)))
+				else: raise ReplayError('Unknown event code: {}'.format(code))
+		except IndexError:
+			raise ReplayError('Truncated event') from None
+		self.endTick = tick
+
+		self.game = Game(players, seed)
+		self.game.aiSwapSource = self
+		self.inputIndex = 0 # Index of the next input
+		self.aiSwapIndex = [0] * nbPlayers # Index of the next AI swap of each player
+		self.keyframeTicks, self.keyframes = [], []
+		self.keyframe()
+
+	def keyframe(self):
+		"""Snapshot the game state, which is mostly the grid buffers"""
+		game = self.game
+		self.keyframeTicks.append(game.tickCount)
+		self.keyframes.append(pickle.dumps((game.players, game.tickCount,
+			self.inputIndex, self.aiSwapIndex), pickle.HIGHEST_PROTOCOL))
+
+	def restore(self, keyframe):
+		game = self.game
+		game.players, game.tickCount, self.inputIndex, self.aiSwapIndex = pickle.loads(keyframe)
+		if game.humanPlayerId != None: game.humanPlayer = game.players[game.humanPlayerId]
+
+	def aiSwap(self, player):
+		"""Return the recorded swap of an AI player, called by the game"""
+		i = self.game.players.index(player)
+		swaps = self.aiSwapIndex[i]
+		if swaps == len(self.aiSwaps[i]) or self.aiSwaps[i][swaps][0] != self.game.tickCount:
+			raise ReplayError('Replay out of sync at tick {}'.format(self.game.tickCount))
+		self.aiSwapIndex[i] += 1
+		return self.aiSwaps[i][swaps][1]
+
+	def step(self):
+		"""Play the inputs of the current tick, then the tick"""
+		game, inputs = self.game, self.inputs
+		while self.inputIndex < len(inputs) and inputs[self.inputIndex][0] == game.tickCount:
+			game.processInputEvent(inputs[self.inputIndex][1])
+			self.inputIndex += 1
+		game.tick()
+		if game.tickCount % self.KEYFRAME_INTERVAL == 0 and game.tickCount > self.keyframeTicks[-1]:
+			self.keyframe()
+
+	def seek(self, tick):
+		"""Bring the game to tick, from the closest keyframe if it is shorter"""
+		tick = min(tick, self.endTick)
+		k = bisect_right(self.keyframeTicks, tick) - 1
+		if tick < self.game.tickCount or self.keyframeTicks[k] > self.game.tickCount:
+			self.restore(self.keyframes[k])
+		while self.game.tickCount < tick:
+			self.step()
+
+	def run(self):
+		"""Play the replay to its end. Return whether the final scores match"""
+		self.seek(self.endTick)
+		return self.scores == None or self.scores == [p.score for p in self.game.players]
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Play a Swap replay at full speed.')
+	parser.add_argument('file', help='replay file')
+	parser.add_argument('--time', type=float, help='stop at this virtual time, in seconds')
+	args = parser.parse_args(argv)
+
+	t = perf_counter()
+	playback = Playback(args.file)
+	if args.time != None:
+		playback.seek(round(args.time / Game.TICK))
+		ok = True
+	else:
+		ok = playback.run()
+	elapsed = perf_counter() - t
+
+	game = playback.game
+	print('seed {} tick {}/{}: {} | {:.2f}s'.format(game.seed, game.tickCount, playback.endTick,
+		' | '.join('{} {} pts'.format(p.name, p.score) for p in game.players), elapsed))
+	if not ok:
+		print('Final scores differ from the recorded ones: {}'.format(playback.scores))
+		return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
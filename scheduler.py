@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: Utf-8 -*-
+
+"""State scheduler for Swap
+
+A state lasts a given duration, then ends. Instead of updating every state at
+each tick, the scheduler keeps states in a heap ordered by end time, and only
+dispatches the states starting or ending to the handlers of their kind. The
+cost of a tick thus depends on the number of events, not of live states.
+
+Time and durations can be counted in any unit, the game counts ticks.
+A state key is either a name, which is also its kind ("block"), or a
+(kind, id) tuple (("fall", 3)). newId allocates integer ids, reusing the
+ones of deleted states.
+"""
+
+from heapq import heappush, heappop
+
+
+class State(object):
+	__slots__ = ('key', 'kind', 'data', 'status', 'start', 'end')
+
+	def __init__(self, key, start, duration, data=None):
+		self.key = key
+		self.kind = key if isinstance(key, str) else key[0]
+		self.data = data
+		self.status = "starting" # starting, running, ending, ended
+		self.start = start
+		self.end = start + duration
+
+	def __repr__(self):
+		name = self.key if isinstance(self.key, str) else '{}#{}'.format(*self.key)
+		return '{}:{}'.format(name, self.status[0])
+
+class Scheduler(object):
+
+	def __init__(self):
+		self.time = 0
+		self._states = {} # State by key
+		self._kinds = {} # States by key, by kind
+		self._heap = [] # (end, sequence number, state), including replaced states
+		self._seq = 0
+		self._events = [] # (state, status) to dispatch
+		self._nextIds = {} # Next never used id, by kind
+		self._freeIds = {} # Heap of the ids released below the next one, by kind
+
+	def __contains__(self, key): return key in self._states
+	def __getitem__(self, key): return self._states[key]
+	def __iter__(self): return iter(self._states)
+	def __len__(self): return len(self._states)
+	def keys(self): return self._states.keys()
+
+	def ofKind(self, kind):
+		"""Return the live states of a kind"""
+		return self._kinds.get(kind, {}).values()
+
+	def count(self, kind):
+		return len(self._kinds.get(kind, ()))
+
+	def newId(self, kind):
+		"""Return the lowest id free for a (kind, id) key.
+
+The id is released when its state is deleted."""
+		free = self._freeIds.setdefault(kind, [])
+		if free: return heappop(free)
+		i = self._nextIds.get(kind, 0)
+		self._nextIds[kind] = i + 1
+		return i
+
+	def transition(self, key, duration, data=None):
+		"""Start a state lasting duration, replacing any state with the same key"""
+		state = State(key, self.time, duration, data)
+		self._states[key] = state
+		self._kinds.setdefault(state.kind, {})[key] = state
+		self._seq += 1
+		heappush(self._heap, (state.end, self._seq, state))
+		self._events.append((state, "starting"))
+
+	def delete(self, key):
+		state = self._states.pop(key)
+		del self._kinds[state.kind][key]
+		state.status = "ended"
+		if state.kind in self._nextIds: # Allocated id
+			heappush(self._freeIds[state.kind], key[1])
+
+	def update(self, dt):
+		"""Advance time by dt, marking the states that end"""
+		self.time += dt
+		heap = self._heap
+		while heap and heap[0][0] <= self.time:
+			state = heappop(heap)[2]
+			if self._states.get(state.key) is state: # Not replaced nor deleted
+				state.status = "ending"
+				self._events.append((state, "ending"))
+
+	def dispatch(self, handlers, *args):
+		"""Call handlers[kind, status](*args, state) for every state that started
+or ended since last dispatch.
+
+A state still running after its ending handler is deleted. States started by
+handlers are dispatched next time."""
+		events, self._events = self._events, []
+		for state, status in events:
+			if self._states.get(state.key) is not state: continue # Replaced or deleted
+			state.status = status
+			handler = handlers.get((state.kind, status))
+			if handler: handler(*args, state)
+			if self._states.get(state.key) is state and state.status == status:
+				if status == "starting": state.status = "running"
+				else: self.delete(state.key)
+
+	def vcrepr(self):
+		"""Return a compact representation of the live states"""
+		return ' '.join(map(repr, self._states.values()))
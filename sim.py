@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: Utf-8 -*-
+
+"""Headless simulation of Swap
+
+Games are advanced tick by tick and nothing is rendered, so a match lasts
+only as long as the CPU needs to compute it. A match is deterministic given
+its seed.
+
+usage: sim.py [-n MATCHES] [--seed SEED] [--duration SECONDS] [--log FILE] [--profile]
+"""
+
+import argparse
+from time import perf_counter
+
+from swap import Game, Player
+from log import configure, startProfiling, stopProfiling, report
+
+
+def simulate(seed, duration=180, playerTypes=('Human', 'AI'), game=None):
+	"""Play a seeded match lasting duration virtual seconds, return its statistics
+
+If game is given, it is reset and reused instead of playerTypes."""
+	if game != None:
+		game.reset(seed)
+	else:
+		game = Game([Player(type_, '{}#{}'.format(type_, i)) for i, type_ in enumerate(playerTypes)], seed)
+
+	nbSteps = round(duration / game.TICK)
+	t = perf_counter()
+	for _ in range(nbSteps):
+		game.tick()
+	elapsed = perf_counter() - t
+
+	return {
+		'seed': seed,
+		'steps': nbSteps,
+		'stepsPerSecond': nbSteps / elapsed if elapsed else float('inf'),
+		'players': [{'name': p.name, 'score': p.score, 'combos': p.nbCombos,
+			'maxMultiplier': p.maxMultiplier, 'comboSizes': dict(p.comboSizes),
+			'chainLengths': dict(p.chainLengths)} for p in game.players]}
+
+def formatResult(result):
+	return 'seed {}: {} | {:.0f} steps/s'.format(result['seed'],
+		' | '.join('{name} {score} pts {combos} combos x{maxMultiplier}'.format(**p)
+		for p in result['players']), result['stepsPerSecond'])
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Run headless seeded Swap matches.')
+	parser.add_argument('-n', '--matches', type=int, default=10, help='number of matches')
+	parser.add_argument('--seed', type=int, default=0, help='seed of the first match')
+	parser.add_argument('--duration', type=float, default=180, help='virtual duration of a match, in seconds')
+	parser.add_argument('--log', metavar='FILE', help='write the debug log to FILE')
+	parser.add_argument('--profile', action='store_true', help='time the hot functions and print a report')
+	args = parser.parse_args(argv)
+	if args.seed < 0: parser.error('SEED must not be negative')
+
+	if args.log: configure(args.log)
+	if args.profile: startProfiling()
+
+	results = []
+	for seed in range(args.seed, args.seed + args.matches):
+		results.append(simulate(seed, args.duration))
+		print(formatResult(results[-1]))
+
+	print('mean: {} | {:.0f} steps/s'.format(
+		' | '.join('{:.1f} pts {:.1f} combos x{:.1f}'.format(
+			*(sum(r['players'][i][key] for r in results) / len(results)
+			for key in ('score', 'combos', 'maxMultiplier')))
+		for i in range(len(results[0]['players']))),
+		sum(r['stepsPerSecond'] for r in results) / len(results)))
+
+	if args.profile:
+		stopProfiling()
+		print(report())
+
+if __name__ == '__main__':
+	main()
@@ -17,111 +17,275 @@ Battle vs CPU/Human
 """
 
 import sys
+import random
 from random import randrange
 from time import time
+from collections import Counter
 from itertoolsExt import flatten
 
 from log import *
-from grid import Grid, Combo, Block
-from state import State, StateMachine
-
-
-SCORES = [2, 3, 5, 10, 20, 50, 100, 200, 400, 600, 800]
-scoreIt = lambda x: SCORES[x-3] if x <= 10 else 1000
+from grid import Grid, Combo, Block, SCORES, scoreIt, groupPositions
+from scheduler import Scheduler
+import ai
 
 
 class Player(object):
+	GRID_SIZE = (12, 20, 4) # Width, height and number of symbols of the grid
 	
-	def __init__(self, type_, name):
+	def __init__(self, type_, name, grid=None):
+		"""Without grid, the player is given one by the game it joins"""
 		assert type_ in ('Human', 'AI'), 'Player type must be among (Human, AI)!'
 		self.type = type_ # Human, AI
 		self.name = name
-		
+
+		self.grid = grid
+		self.aiRng = None # Random generator of the AI, the grid one if None
+		self.aiTable = None # Chain values cached by the AI, see Game
+		self.reset(regenerate=False)
+
+	def reset(self, regenerate=True):
+		"""Prepare a new match, regenerating the grid in its own buffer"""
+		if regenerate and self.grid != None: self.grid.reset()
+
 		self.score = 0
 		self.scoreMultiplier = 1
 		self.swapperPos = (0, 0)
-		
-		self.grid = Grid(12, 20, 4)
-		
-		self.stateMachine = StateMachine()
 
-class Game(object):
+		self.nbCombos = 0
+		self.maxMultiplier = 1
+		self.comboSizes = Counter() # Number of combos by size
+		self.chainLengths = Counter() # Number of chains by number of combo groups
+
+		self.stateMachine = Scheduler()
+		self.comboIndex = {} # (combo state, combo index) of the pending combos, by block position
+
+	def indexCombo(self, state, i):
+		"""Index the blocks of the combo i of a combo state"""
+		for pos in state.data[i].positions():
+			self.comboIndex.setdefault(pos, []).append((state, i))
+
+	def unindexCombo(self, state, i):
+		for pos in state.data[i].positions():
+			entries = self.comboIndex[pos]
+			entries.remove((state, i))
+			if not entries: del self.comboIndex[pos]
+
+	def endChain(self):
+		"""Record the current chain and reset the score multiplier"""
+		if self.scoreMultiplier > 1:
+			self.chainLengths[self.scoreMultiplier - 1] += 1
+		self.scoreMultiplier = 1
 
-	def __init__(self):
-		self.players = [Player('Human', 'Human'), Player('AI', 'BOT')]
+class Game(object):
+	"""Game running in fixed time steps (ticks).
+
+Given a seed, a game is deterministic: the same inputs at the same ticks
+always give the same game."""
+	TICK = .05 # Duration of a tick, in seconds
+	MAX_CATCHUP_TICKS = 10 # Maximal number of ticks run by an update
+	AI_DEPTH = 2 # Number of successive swaps searched by AI
+	AI_TIME_BUDGET = .1 # Maximal duration of an AI search, in seconds, unless seeded
+	AI_NODE_BUDGET = 1000 # Maximal number of swaps tried by an AI search
+	# State durations, in seconds
+	FIRST_AI_SWAP_DELAY, AI_SWAP_DELAY = 2, 1.5
+	FIRST_BLOCK_DELAY, BLOCK_DELAY = 4, .5
+	FALL_DELAY = .2
+	COMBO_DELAY = 2
+
+	def __init__(self, players=None, seed=None, gridPool=None, aiBitboards=False, aiTable=False):
+		"""If gridPool is given, the grids of the players are taken from it and
+given back when the game is reset.
+
+If aiBitboards, the grids of the AI players keep bitboards, and the AI only
+searches the last swap among those making a combo. It then resolves the chain
+of every swap it tries, which costs more than it saves.
+
+If aiTable, each AI player caches chain values in a TranspositionTable, which
+keeps the grid hash. Few values are found again, and hashing slows every
+write, so it is off by default."""
+		assert seed == None or seed >= 0, 'seed must not be negative!'
+		self.seed = seed if seed != None else random.getrandbits(63)
+		self.rng = random.Random(self.seed)
+		self.aiTimeBudget = self.AI_TIME_BUDGET if seed == None else None
+		self.gridPool = gridPool
+		self.aiBitboards = aiBitboards
+		if players == None:
+			players = [Player('Human', 'Human'), Player('AI', 'BOT')]
+		for player in players: # Regenerate the grids from the seed
+			self.seedPlayer(player)
+			if aiTable and player.type == 'AI':
+				player.aiTable = ai.TranspositionTable()
+		self.players = players
 		self.humanPlayerId = listFind(self.players, 'Human', key=lambda e: e.type)
-		self.humanPlayer = self.players[self.humanPlayerId]
-		
-		self.lastTime = time()
+		self.humanPlayer = self.players[self.humanPlayerId] if self.humanPlayerId != None else None
+
 		self.pause = False
+		self.recorder = None # Records inputs and AI swaps, see replay.Recorder
+		self.aiSwapSource = None # Plays AI swaps instead of the AI, see replay.Playback
+		self.handlers = {
+			("AI_swap", "starting"): self.startAISwap,
+			("AI_swap", "ending"): self.endAISwap,
+			("block", "ending"): self.endBlock,
+			("fall", "ending"): self.endFall,
+			("combo", "ending"): self.endCombo}
 
 		INFO("Starting Swap")
-		
+		self.start()
+
+	def newRng(self):
+		"""Return a random generator seeded by the game one"""
+		return random.Random(self.rng.getrandbits(64))
+
+	def seedPlayer(self, player):
+		"""Regenerate the grid of player from the game generator, and give its AI
+its own generator. A player without grid gets a new one.
+
+The AI draws from its own generator so that its choices, which may depend
+on the wall clock, never shift the blocks spawned in the grid."""
+		gridSeed = self.rng.getrandbits(64)
+		player.aiRng = self.newRng()
+		if self.gridPool != None:
+			if player.grid != None: self.gridPool.release(player.grid)
+			player.grid = self.gridPool.get(gridSeed)
+		elif player.grid == None:
+			player.grid = Grid(*player.GRID_SIZE, rng=random.Random(gridSeed))
+		else:
+			player.grid.reset(gridSeed)
+		if self.aiBitboards and player.type == 'AI':
+			player.grid.enableBitboards()
+
+	def prepare(self, seed):
+		"""Have the grid pool generate the grids of reset(seed) ahead of time"""
+		rng = random.Random(seed)
+		for player in self.players: # Same draws as seedPlayer
+			self.gridPool.prepare(rng.getrandbits(64))
+			rng.getrandbits(64)
+
+	def ticks(self, duration):
+		"""Return the number of ticks lasting duration seconds"""
+		return max(1, round(duration / self.TICK))
+
+	def start(self):
+		"""Arm the initial states of every player"""
+		self.lastTime = time()
+		self.tickCount = 0
+		self.accumulator = 0
 		for player in self.players:
 			if player.type == 'AI':
-				player.stateMachine.transition("AI_swap", 2) # To enable AI
-			player.stateMachine.transition("block", 4)
-
-	def update(self):
-
-		currentTime = time()
-		dt = currentTime - self.lastTime
-		self.lastTime = currentTime
-
-		if self.pause: return
-
+				player.stateMachine.transition("AI_swap", self.ticks(self.FIRST_AI_SWAP_DELAY)) # To enable AI
+			player.stateMachine.transition("block", self.ticks(self.FIRST_BLOCK_DELAY))
+
+	def reset(self, seed=None):
+		"""Start a new match with the same players, reusing their grids.
+
+The grids are regenerated from seed, or from a new random seed if not given.
+Seeds are not negative, so that replays can store them."""
+		assert seed == None or seed >= 0, 'seed must not be negative!'
+		self.aiTimeBudget = self.AI_TIME_BUDGET if seed == None else None
+		self.seed = seed if seed != None else random.getrandbits(63)
+		self.rng.seed(self.seed)
+		for player in self.players:
+			self.seedPlayer(player)
+			player.reset(regenerate=False)
+		self.pause = False
+		self.start()
+
+	def update(self, dt=None):
+		"""Run the ticks due after dt seconds, measured by the wall clock if not
+given. Return the number of ticks run.
+
+Time not consumed by ticks is accumulated for the next update. After a
+stall, at most MAX_CATCHUP_TICKS ticks are run and the rest is dropped."""
+
+		if dt == None:
+			currentTime = time()
+			dt = currentTime - self.lastTime
+			self.lastTime = currentTime
+
+		if self.pause: return 0
+
+		self.accumulator += dt
+		nbTicks = 0
+		while self.accumulator >= self.TICK:
+			if nbTicks == self.MAX_CATCHUP_TICKS:
+				self.accumulator = 0
+				break
+			self.tick()
+			self.accumulator -= self.TICK
+			nbTicks += 1
+		return nbTicks
+
+	def tick(self):
+		"""Advance the game by one tick"""
 		for player in self.players:
 			#if any(player.stateMachine.isChanging(e) for e in player.stateMachine):
 			#	DEBUG("State: %s", player.stateMachine.vcrepr())
-		
+
 			self.stepStateMachine(player)
-			player.stateMachine.update(dt)
+			player.stateMachine.update(1)
+			player.grid.clearChanges() # The game looks for combos around the changes itself
+		self.tickCount += 1
 
 	def stepStateMachine(self, player):
-		
-		for stateName in tuple(player.stateMachine.keys()):
-
-			if stateName == "AI_swap":
-				if player.stateMachine["AI_swap"].status == "starting":
-					player.swapperPos = player.grid.randomSwap()
-				elif player.stateMachine["AI_swap"].status == "ending":
-					self.swap(player)
-					player.stateMachine.transition("AI_swap", 1.5)
-					
-			elif stateName == "block":
-				if player.stateMachine["block"].status == "ending":
-					player.grid.spawnBlock()
-					self.checkAndFall(player)
-					player.stateMachine.transition("block", .5)
-
-			elif stateName.startswith("fall#"):
-				if player.stateMachine[stateName].status == "ending":
-					pos = player.stateMachine[stateName].data
-					player.grid.fallStepPos(*pos)
-					if player.grid.isHole(*pos):
-						player.stateMachine.transition(stateName, .2, pos)
-					else: # Falling ended
-						lowerHoles = player.grid.lowerHoles([pos[0]])
-						if lowerHoles:
-							player.stateMachine.transition(stateName, .2, lowerHoles[0])
-						else:
-							player.stateMachine.delete(stateName)
-							sumFalls = sum(1 for name in player.stateMachine if name.startswith("fall#"))
-							comboGroup = self.checkAndCombo(player, "fall", pos)
-							if sumFalls == 0 and not comboGroup:
-								player.scoreMultiplier = 1
-
-			elif stateName.startswith("combo#"):
-				if player.stateMachine[stateName].status == "ending":
-					#DEBUG("Combos %s\n%s", stateName, player.stateMachine[stateName].data)
-					comboGroup = player.stateMachine[stateName].data
-
-					comboGroup = updateComboGroupLazy(player, comboGroup)
-					self.processCombos(player, comboGroup)
-
-					player.stateMachine.delete(stateName)
-					#DEBUG("After delete combo: %s", self.getComboGroups(player))
-					self.checkAndFall(player)
+		"""Dispatch the states of player that started or ended to their handlers"""
+		player.stateMachine.dispatch(self.handlers, player)
+
+	def startAISwap(self, player, state):
+		if self.aiSwapSource != None:
+			player.swapperPos = self.aiSwapSource.aiSwap(player)
+		else:
+			player.swapperPos = ai.chooseSwap(player.grid, self.AI_DEPTH, self.aiTimeBudget,
+				self.AI_NODE_BUDGET, player.aiRng, player.aiTable)
+		if self.recorder != None: self.recorder.aiSwap(player)
+
+	def endAISwap(self, player, state):
+		self.swap(player)
+		player.stateMachine.transition("AI_swap", self.ticks(self.AI_SWAP_DELAY))
+
+	def endBlock(self, player, state):
+		player.grid.spawnBlock()
+		self.checkAndFall(player)
+		player.stateMachine.transition("block", self.ticks(self.BLOCK_DELAY))
+
+	def endFall(self, player, state):
+		"""Gravity pass: every column whose fall step is due this tick falls one
+step, then combos are looked for once around all the blocks that landed.
+
+Each column keeps its own fall state, hence its own timing. The first one
+ending runs the pass for all of them, and the others are then skipped."""
+		sm, grid = player.stateMachine, player.grid
+		falls = [fall for fall in sm.ofKind("fall") if fall.status == "ending"]
+		for fall in falls:
+			grid.fallStepPos(*fall.data)
+
+		landed = [] # Former holes of the columns that stopped falling
+		for fall in falls:
+			pos = fall.data
+			if grid.isHole(*pos):
+				sm.transition(fall.key, self.ticks(self.FALL_DELAY), pos)
+				continue
+			lowerHoles = grid.lowerHoles([pos[0]])
+			if lowerHoles:
+				sm.transition(fall.key, self.ticks(self.FALL_DELAY), lowerHoles[0])
+			else: # Falling ended
+				sm.delete(fall.key)
+				landed.append(pos)
+
+		if landed:
+			comboGroup = self.checkAndCombo(player, "fall", landed)
+			if sm.count("fall") == 0 and not comboGroup:
+				player.endChain()
+
+	def endCombo(self, player, state):
+		#DEBUG("Combos %s\n%s", state.key, state.data)
+		comboGroup = updateComboGroupLazy(player, state.data)
+		self.processCombos(player, comboGroup)
+
+		for i in range(len(state.data)):
+			player.unindexCombo(state, i)
+		player.stateMachine.delete(state.key)
+		#DEBUG("After delete combo: %s", self.getComboGroups(player))
+		self.checkAndFall(player)
 
 	def checkAndFall(self, player, focusX=None):
 		"""Check whether some blocks have to fall. Return lower holes.
@@ -132,79 +296,90 @@ class Game(object):
 		lowerHoles = player.grid.lowerHoles(focusX)
 		#DEBUG("Lower holes: %s", lowerHoles)
 		for pos in lowerHoles:
-			if "fall#" + str(pos[0]) not in player.stateMachine:
-				player.stateMachine.transition("fall#" + str(pos[0]), .2, pos)
+			if ("fall", pos[0]) not in player.stateMachine:
+				player.stateMachine.transition(("fall", pos[0]), self.ticks(self.FALL_DELAY), pos)
 		return lowerHoles
 
 	def getComboGroups(self, player):
-		return [player.stateMachine[name].data for name in player.stateMachine if name.startswith("combo#")]
+		return [state.data for state in player.stateMachine.ofKind("combo")]
 
 	def genComboId(self, player):
-		for i in range(100):
-			if "combo#" + str(i) not in player.stateMachine:
-				return i
-		raise RuntimeError("Too much combos")
+		return player.stateMachine.newId("combo")
 
 	def checkAndCombo(self, player, checkType, pos):
 		"""Check whether there are combos. Return combo group.
 
-		Creates combo state."""
+		Creates combo state. pos is the swap position, or the list of
+		former holes after falls."""
 
 		if checkType == "fall":
-			comboGroup = player.grid.combosAfterFall(pos)
+			comboGroup = player.grid.combosAfterFalls(pos)
 		elif checkType == "swap":
 			comboGroup = player.grid.combosAfterSwap(pos)
 		else: raise ValueError("Wrong check type: " + str(checkType))
 
-		if comboGroup:
+		if comboGroup and player.comboIndex: # Filter already found combos and update old combo groups
 			#DEBUG("Found combo group %s\nComboGroups: %s", comboGroup, self.getComboGroups(player))
-			fallingX = [pos[0] for pos in player.grid.lowerHoles()]
-
-			# Filter already found combos and update old combo groups
-			oldStates = [player.stateMachine[name] for name in player.stateMachine if name.startswith("combo#")]
-			for state in oldStates: # every state
+			fallingX = {state.key[1] for state in player.stateMachine.ofKind("fall")}
+			kept = []
+			for combo in comboGroup:
+				if any(x in fallingX for x, y in combo.positions()):
+					DEBUG('Filter#1 combo: %s', combo)
+				else: kept.append(combo)
+			comboGroup = kept
+
+			# Old combos sharing more than one block with each new combo, found
+			# through the index. They are reconciled in the order of the states.
+			rank = {state: r for r, state in enumerate(player.stateMachine.ofKind("combo"))}
+			matches = {} # Indices of the new combos, by (rank, state, old combo index)
+			for nci, combo in enumerate(comboGroup):
+				shared = Counter(entry for pos in combo.positions()
+					for entry in player.comboIndex.get(pos, ()) if entry[0].data[entry[1]].color == combo.color)
+				for (state, oci), count in shared.items():
+					if count > 1: matches.setdefault((rank[state], state, oci), []).append(nci)
+
+			removed = set()
+			for r, state, oci in sorted(matches):
 				oldComboGroup = state.data
-				
-				oci = 0 # old combo index
-				while oci < len(oldComboGroup): # every stored combo
-					
-					nci = 0 # new combo index
-					while nci < len(comboGroup): # every current combo
-						#DEBUG('Current combo group: %s', comboGroup)
-						if any(p[0] in fallingX for p in comboGroup[nci]):
-							DEBUG('Filter#1 combo: %s', comboGroup[nci])
-							comboGroup.pop(nci)
-							continue
-						# If any common block
-						if comboGroup[nci] and sum(p in oldComboGroup[oci] for p in comboGroup[nci]) > 1:
-							if oldComboGroup[oci] != comboGroup[nci]:
-								DEBUG('Update old combo: %s -> %s', oldComboGroup[oci], comboGroup[nci])
-								oldComboGroup[oci] = comboGroup[nci] # Update old combo
-							else:
-								DEBUG('Filter#2 combo: %s', comboGroup[nci])
-							comboGroup.pop(nci)
-							continue
-						nci += 1
-					oci += 1
+				for nci in matches[r, state, oci]:
+					combo = comboGroup[nci]
+					if nci in removed or sum(p in oldComboGroup[oci] for p in combo.positions()) <= 1: continue
+					if oldComboGroup[oci] != combo:
+						DEBUG('Update old combo: %s -> %s', oldComboGroup[oci], combo)
+						player.unindexCombo(state, oci)
+						oldComboGroup[oci] = combo # Update old combo
+						player.indexCombo(state, oci)
+					else:
+						DEBUG('Filter#2 combo: %s', combo)
+					removed.add(nci)
+			comboGroup = [combo for nci, combo in enumerate(comboGroup) if nci not in removed]
 
+		if comboGroup:
 			DEBUG("Add combo group %s", comboGroup)
-			if comboGroup:
-				player.stateMachine.transition("combo#" + str(self.genComboId(player)), 2, comboGroup)
+			key = ("combo", self.genComboId(player))
+			player.stateMachine.transition(key, self.ticks(self.COMBO_DELAY), comboGroup)
+			for i in range(len(comboGroup)):
+				player.indexCombo(player.stateMachine[key], i)
 
 		return comboGroup
 
 	def processCombos(self, player, comboGroup):
 		if not len(comboGroup): return
-		comboGroupPos = set(flatten(comboGroup))
-		DEBUG('Score combos: %s %s', scoreIt(len(comboGroupPos)) * player.scoreMultiplier, comboGroup)
+		comboGroupPos = groupPositions(comboGroup)
+		score = scoreIt(len(comboGroupPos)) * player.scoreMultiplier
+		DEBUG('Score combos: %s %s', score, comboGroup)
 		
-		player.score += scoreIt(len(comboGroupPos)) * player.scoreMultiplier
+		player.score += score
 		player.scoreMultiplier += 1
+		player.nbCombos += len(comboGroup)
+		player.comboSizes.update(len(combo) for combo in comboGroup)
+		player.maxMultiplier = max(player.maxMultiplier, player.scoreMultiplier)
 		
-		for pos in comboGroupPos: # Remove combos
-			player.grid[pos] = 0
+		for x, y in comboGroupPos: # Remove combos
+			player.grid.setCell(x, y, 0)
 
 	def processInputEvent(self, name):
+		if self.recorder != None: self.recorder.input(name)
 		player = self.humanPlayer
 		if name == "swap":
 			self.swap(player)
@@ -225,6 +400,8 @@ class Game(object):
 		elif direction == 'down': player.swapperPos = (x, min(y+1, player.grid.height-1))
 		elif direction == 'left': player.swapperPos = (max(x-1, 0), y)
 
+profile(Game, 'update', 'tick', 'stepStateMachine', 'checkAndCombo', 'checkAndFall')
+
 def updateComboGroupLazy(player, comboGroup):
 		"""Computes the final combo group based on combo state start and end, using
 the lazy startegy.
@@ -235,8 +412,8 @@ include any combo from start state that remains in end state"""
 		newComboGroup = []
 		for combo in comboGroup:
 			orientation = combo.orientation()
-			if orientation == 'h': comboTest = player.grid.comboHorizontalAround(*combo[0])
-			elif orientation == 'v': comboTest = player.grid.comboVerticalAround(*combo[0])
+			if orientation == 'h': comboTest = player.grid.comboHorizontalAround(*combo.positions()[0])
+			elif orientation == 'v': comboTest = player.grid.comboVerticalAround(*combo.positions()[0])
 			else: raise NotImplemented
 			if combo == comboTest:
 				newComboGroup.append(combo)
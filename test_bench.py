@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: Utf-8 -*-
+
+"""
+Benchmarks of the hot paths of Grid and Game, for pytest-benchmark
+
+Every grid is generated from a fixed seed, so runs are comparable. To record
+a baseline, then compare a later run against it, failing on regressions:
+
+	pytest test_bench.py --benchmark-save=baseline
+	pytest test_bench.py --benchmark-compare --benchmark-compare-fail=mean:10%
+
+Baselines are stored as JSON under .benchmarks/, by machine, and are not
+committed: the machine key only names the OS and the Python version, so a
+baseline recorded on one computer would be compared with the timings of
+another, and --benchmark-compare-fail errors out where there is none.
+"""
+
+from random import Random
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from grid import Grid
+from sim import simulate
+
+SIZES = [(6, 4), (12, 20), (50, 30), (200, 100)] # (width, height)
+SEED = 42
+
+def makeGrid(size, holes=0):
+	"""Return a seeded grid of size, with holes random blocks removed"""
+	rng = Random(SEED)
+	grid = Grid(*size, nbSymbols=5, rng=rng)
+	for _ in range(holes):
+		grid.setCell(rng.randrange(grid.width), rng.randrange(grid.height), 0)
+	return grid
+
+def holedGrids(size):
+	"""Return a setup for benchmark.pedantic giving a fresh holed grid each round"""
+	grid = makeGrid(size, holes=size[0] * size[1] // 10)
+	data = [list(column) for column in grid]
+	return lambda: ((Grid(data=data, nbSymbols=5),), {})
+
+sizes = pytest.mark.parametrize('size', SIZES, ids=lambda size: '{}x{}'.format(*size))
+
+@sizes
+def test_generate(benchmark, size):
+	grid = makeGrid(size)
+	benchmark(grid.reset)
+
+@sizes
+def test_combosAll(benchmark, size):
+	grid = makeGrid(size)
+	benchmark(grid.combosAll)
+
+@sizes
+def test_comboSwaps(benchmark, size):
+	grid = makeGrid(size)
+	grid.enableBitboards()
+	benchmark(grid.comboSwaps)
+
+@sizes
+def test_combosAfterSwap(benchmark, size):
+	grid = makeGrid(size)
+	pos = grid.randomSwap()
+	grid.swap(*pos)
+	benchmark(grid.combosAfterSwap, pos)
+
+@sizes
+def test_combosAfterFall(benchmark, size):
+	grid = makeGrid(size, holes=size[0] * size[1] // 10)
+	grid.fallInstant()
+	benchmark(grid.combosAfterFall, (size[0] // 2, size[1] - 1))
+
+@sizes
+def test_lowerHoles(benchmark, size):
+	grid = makeGrid(size, holes=size[0] * size[1] // 10)
+	benchmark(grid.lowerHoles)
+
+@sizes
+def test_fallInstant(benchmark, size):
+	benchmark.pedantic(Grid.fallInstant, setup=holedGrids(size), rounds=50)
+
+@sizes
+def test_fallStep(benchmark, size):
+	benchmark.pedantic(Grid.fallStep, setup=holedGrids(size), rounds=50)
+
+@sizes
+def test_randomSwap(benchmark, size):
+	grid = makeGrid(size)
+	benchmark(grid.randomSwap)
+
+def test_game(benchmark):
+	benchmark.pedantic(simulate, args=(SEED, 10), rounds=3)
@@ -8,6 +8,7 @@ Tests for Swap
 from time import time, sleep
 
 from swap import *
+from grid import GridPool
 from itertoolsExt import flatten
 
 def rotateMatrix(mat):
@@ -289,6 +290,358 @@ def test10():
 	print("combo horiz (3,2):", grid.comboHorizontalAround(3, 2))
 	print("combo horiz (3,3):", grid.comboHorizontalAround(3, 3))
 
+def test11():
+	_grid = rotateMatrix([\
+	[3, 0, 0, 4, 4, 0],
+	[3, 0, 0, 4, 0, 0],
+	[3, 2, 2, 2, 4, 1],
+	[1, 1, 1, 2, 2, 1]])
+	grid = Grid(data=_grid, nbSymbols=5)
+	print(grid.reprBlocks())
+
+	runs = grid.runs()
+	print("runs:", runs)
+	print("combos all:", grid.combosAll())
+	assert [Combo.fromRun(*run) for run in runs] == grid.combosAll()
+	assert runs == [(0, 0, 3, 'v', 3), (1, 2, 3, 'h', 2), (0, 3, 3, 'h', 1)]
+
+	lazy, listed = Combo.fromRun(0, 0, 3, 'h', 1), Combo([(0, 0), (1, 0), (2, 0)], 1)
+	assert lazy == listed
+	for combo in (lazy, listed):
+		assert (1, 0) in combo and Block((1, 0), 1) in combo
+		assert (1, 1) not in combo and Block((1, 0), 2) not in combo
+
+def test12():
+	_grid = rotateMatrix([\
+	[1, 0, 0, 4, 4, 0],
+	[2, 0, 0, 4, 0, 0],
+	[3, 2, 3, 3, 4, 1],
+	[1, 1, 3, 1, 2, 1]])
+	grid = Grid(data=_grid, nbSymbols=5)
+	print(grid.reprBlocks())
+	print("pending combos:", grid.pendingCombos())
+
+	grid.swap(0, 2)
+	print(grid.reprBlocks())
+	print("holes:", grid.lowerHoles())
+	comboGroup = grid.pendingCombos()
+	print("pending combos after swap (0, 2):", comboGroup)
+	assert comboGroup == grid.combosAfterSwap((0, 2)) != []
+	assert grid.pendingCombos() == []
+
+	grid.swap(0, 2)
+	grid.clearChanges()
+	assert grid.pendingCombos() == []
+
+	game = Game(seed=12)
+	for _ in range(400): game.tick()
+	assert all(not player.grid.clearChanges() for player in game.players)
+
+def test13():
+	_grid = rotateMatrix([\
+	[1, 0, 0, 4, 4, 0],
+	[2, 0, 0, 4, 0, 0],
+	[3, 2, 3, 3, 4, 1],
+	[1, 1, 3, 1, 2, 1]])
+	grid = Grid(data=_grid, nbSymbols=5)
+	before = grid.reprDigits()
+	print(grid.reprBlocks())
+
+	with grid.trial():
+		grid.swap(0, 2)
+		for pos in set(flatten(grid.combosAfterSwap((0, 2)))): # Remove combos
+			grid[pos] = 0
+		grid.fallInstant()
+		print(grid.reprBlocks())
+		print("holes:", grid.lowerHoles())
+
+	print(grid.reprBlocks())
+	assert grid.reprDigits() == before
+
+def test14():
+	_grid = rotateMatrix([\
+	[0, 0, 2, 0, 0],
+	[0, 0, 3, 2, 4],
+	[0, 0, 3, 1, 1],
+	[3, 2, 3, 2, 1]])
+	grid = Grid(data=_grid, nbSymbols=5)
+	print(grid.reprBlocks())
+
+	steps = grid.resolveInstant()
+	for comboGroup, score in steps:
+		print("chain step:", comboGroup, score)
+	print(grid.reprBlocks())
+	assert [score for comboGroup, score in steps] == [scoreIt(3), scoreIt(3) * 2]
+	assert grid.resolveInstant() == []
+
+	grid = Grid(data=[[1, 2, 3], [1, 3, 2], [1, 2, 3]], nbSymbols=4)
+	grid.pendingCombos() # Combos already on the grid are still resolved
+	assert [score for comboGroup, score in grid.resolveInstant()] == [scoreIt(3)]
+	assert grid.combosAll() == []
+
+def test15():
+	from io import BytesIO
+	from replay import Recorder, Playback
+	game = Game()
+	out = BytesIO()
+	recorder = Recorder(game, out)
+	for i in range(600):
+		if i % 5 == 0: game.processInputEvent(('up', 'left', 'swap', 'down', 'right', 'swap')[i % 6])
+		game.tick()
+	recorder.close()
+	print("replay:", len(out.getvalue()), "bytes", [p.score for p in game.players])
+
+	playback = Playback(BytesIO(out.getvalue()))
+	assert playback.run()
+	final = [p.grid.reprDigits() for p in playback.game.players]
+	playback.seek(450)
+	playback.seek(600)
+	assert [p.grid.reprDigits() for p in playback.game.players] == final
+
+	try: Game(seed=-5)
+	except AssertionError as e: print("negative seed:", e)
+	else: assert False, 'a replay cannot store a negative seed'
+
+def test16():
+	_grid = rotateMatrix([\
+	[0, 0, 2, 0, 0],
+	[0, 1, 3, 2, 4],
+	[2, 4, 3, 1, 1],
+	[3, 2, 4, 3, 1]])
+	grid = Grid(data=_grid, nbSymbols=5, bitboards=True)
+	print(grid.reprBlocks())
+
+	swaps = []
+	for x, y in ai.legalSwaps(grid):
+		with grid.trial():
+			grid.swap(x, y)
+			if grid.combosAfterSwap((x, y)): swaps.append((x, y))
+	print("combo swaps:", grid.comboSwaps())
+	assert grid.comboSwaps() == swaps and grid.hasComboSwap()
+	assert not grid.hasCombo()
+	with grid.trial():
+		grid.swap(*swaps[0])
+		assert grid.hasCombo()
+	assert grid.bitboard(3) == sum(1 << x*grid.height + y
+		for x in range(grid.width) for y in range(grid.height) if grid[x, y] == 3)
+
+	players = lambda: [Player('Human', 'Human'), Player('AI', 'BOT')]
+	assert all(not p.grid.hasBitboards() for p in Game(players(), seed=16).players) # Off by default
+	assert [p.grid.hasBitboards() for p in Game(players(), seed=16, aiBitboards=True).players] == [False, True]
+
+def test17():
+	grid = Grid(8, 10, 4, rng=random.Random(17), hashed=True)
+	before = grid.hash
+	with grid.trial():
+		grid.swap(*next(ai.legalSwaps(grid)))
+		swapped = grid.hash
+		assert swapped != before
+		assert Grid(data=[list(column) for column in grid], nbSymbols=4, hashed=True).hash == swapped
+	assert grid.hash == before
+
+	table = ai.TranspositionTable(size=4)
+	swap = ai.chooseSwap(grid, 2, None, None, random.Random(17), table)
+	print("swap:", swap, "hits:", table.hits, "misses:", table.misses)
+	assert ai.chooseSwap(grid, 2, None, None, random.Random(17)) == swap
+	assert len(table.values) <= 4 and grid.hash == before
+
+	players = lambda: [Player('AI', 'BOT#0'), Player('AI', 'BOT#1')]
+	games = [Game(players(), seed=17), Game(players(), seed=17, aiTable=True)]
+	for game in games:
+		for _ in range(600): game.tick()
+	assert all(p.aiTable == None and p.grid._zobrist == None for p in games[0].players) # Off by default
+	assert all(p.aiTable != None for p in games[1].players)
+	assert [p.grid.reprDigits() for p in games[0].players] == [p.grid.reprDigits() for p in games[1].players]
+
+def test18():
+	sm = Scheduler()
+	events = []
+	def endBlock(state):
+		events.append(('end', state.key))
+		sm.transition('spawn', 1) # Started by a handler
+	handlers = {('block', 'ending'): endBlock,
+		('spawn', 'starting'): lambda state: events.append(('start', state.key))}
+
+	sm.transition('block', 2)
+	sm.transition('block', 3) # Replaces the first one, which never ends
+	sm.update(2)
+	sm.dispatch(handlers)
+	assert events == [] and sm['block'].status == 'running'
+	sm.update(1)
+	sm.dispatch(handlers)
+	print("events:", events, sm.vcrepr())
+	assert events == [('end', 'block')] and 'block' not in sm # Deleted once ended
+	sm.dispatch(handlers)
+	assert events[-1] == ('start', 'spawn') and sm['spawn'].status == 'running'
+
+	ids = [sm.newId('combo') for _ in range(3)]
+	for i in ids: sm.transition(('combo', i), 1)
+	sm.delete(('combo', 2))
+	sm.delete(('combo', 0))
+	assert ids == [0, 1, 2] and sm.count('combo') == 1
+	assert [sm.newId('combo') for _ in range(3)] == [0, 2, 3] # Lowest first
+
+def test19():
+	for seed in range(200):
+		grid = Grid(12, 20, 4, rng=random.Random(seed))
+		assert not grid.runs(), grid
+	print(grid.reprBlocks())
+
+	grids = Grid.generateMany(3, 8, 10, 4, seed=19)
+	seeds = random.Random(19)
+	for grid in grids: # Each grid can be regenerated alone
+		assert grid.reprDigits() == Grid(8, 10, 4, rng=random.Random(seeds.getrandbits(64))).reprDigits()
+		assert not grid.runs()
+	assert len({grid.reprDigits() for grid in grids}) == 3
+
+	try: Grid(8, 10, 3)
+	except AssertionError as e: print("3 symbols:", e)
+	else: assert False, 'a grid of 2 colors cannot always be generated'
+
+def test20():
+	grid = Grid(8, 10, 4, rng=random.Random(1))
+	for seed in (20, 21):
+		grid.reset(seed)
+		other = Grid(8, 10, 4, rng=random.Random(seed))
+		assert grid.reprDigits() == other.reprDigits()
+		assert grid.rng.random() == other.rng.random() # Same blocks spawned afterwards
+
+	pool = GridPool(8, 10, 4)
+	pool.prepare(1)
+	pool.prepare(2)
+	grid = pool.get(2)
+	assert grid.reprDigits() == Grid(8, 10, 4, rng=random.Random(2)).reprDigits()
+	assert not pool._ready and len(pool._spares) == 1 # 1 was never asked for, and recycled
+	pool.get(3)
+	pool.release(grid)
+	assert pool.get(4) is grid # Regenerated in place
+	assert grid.reprDigits() == Grid(8, 10, 4, rng=random.Random(4)).reprDigits()
+	assert not pool._ready and not pool._spares and (pool.hits, pool.misses) == (1, 2)
+
+	import farm # Chunks of consecutive seeds, each match preparing the next one
+	farm._game = Game([Player('AI', 'BOT#0'), Player('AI', 'BOT#1')], gridPool=GridPool(*Player.GRID_SIZE))
+	pool = farm._game.gridPool
+	for seed in (30, 31, 32, 33, 40, 41): farm.playMatch((seed, 1))
+	print("pool hits:", pool.hits, "misses:", pool.misses)
+	assert (pool.hits, pool.misses) == (8, 6) # Only the first match of each chunk, and the game creation, miss
+	assert len(pool._ready) == 2 # The grids of 34 were recycled, those of 42 are left
+
+	pool = GridPool(8, 10, 4, background=True)
+	for seed in (4, 5): pool.prepare(seed)
+	assert [pool.get(seed).reprDigits() for seed in (4, 5)] == \
+		[Grid(8, 10, 4, rng=random.Random(seed)).reprDigits() for seed in (4, 5)]
+
+	game = Game([Player('AI', 'BOT#0'), Player('AI', 'BOT#1')], seed=20)
+	pooled = Game([Player('AI', 'BOT#0'), Player('AI', 'BOT#1')], seed=20,
+		gridPool=GridPool(*Player.GRID_SIZE))
+	assert [p.grid.reprDigits() for p in game.players] == [p.grid.reprDigits() for p in pooled.players]
+
+	game.reset()
+	assert game.aiTimeBudget == Game.AI_TIME_BUDGET # Unseeded, the AI searches on the clock
+	game.reset(20)
+	assert game.aiTimeBudget == None and [p.grid.reprDigits() for p in game.players] == \
+		[p.grid.reprDigits() for p in pooled.players]
+
+def test21():
+	_grid = rotateMatrix([\
+	[0, 1, 1, 0],
+	[4, 0, 0, 4],
+	[1, 0, 0, 1],
+	[2, 3, 2, 3],
+	[3, 2, 3, 2]])
+	game = Game([Player('Human', 'Human')], seed=21)
+	player = game.players[0]
+	player.grid = Grid(data=_grid, nbSymbols=5)
+	player.stateMachine = Scheduler() # No block spawned
+	grid = player.grid
+	steps, found = [], []
+	fallStepPos, combosAfterFalls = grid.fallStepPos, grid.combosAfterFalls
+	grid.fallStepPos = lambda x, y: (steps.append((game.tickCount, x)), fallStepPos(x, y))
+	grid.combosAfterFalls = lambda holes: found.append(combosAfterFalls(holes)) or found[-1]
+
+	assert game.checkAndFall(player) == [(1, 2), (2, 2)]
+	while player.stateMachine.count("fall") or not found: game.tick()
+	print(grid.reprBlocks())
+	print("fall steps:", steps, "combos:", found)
+	assert len(steps) == 4 and steps[0][0] == steps[1][0] != steps[2][0] == steps[3][0]
+	assert found == [[Combo.fromRun(0, 2, 4, 'h', 1)]] # Landed together, found once
+	assert [state.data for state in player.stateMachine.ofKind("combo")] == found
+
+def test22():
+	_grid = rotateMatrix([\
+	[0, 0, 0, 0, 0],
+	[0, 3, 0, 0, 0],
+	[0, 1, 0, 0, 0],
+	[0, 1, 0, 1, 0],
+	[0, 2, 3, 1, 3]])
+	grid = Grid(data=_grid, nbSymbols=4)
+	assert ai.search(grid, 1, ai.Budget())[0] == 0 # No swap makes a combo
+	budget = ai.Budget(None, 100)
+	try: ai.search(grid, 1, budget), ai.search(grid, 2, budget)
+	except ai.BudgetExceeded as e: partial = e.partial
+	else: assert False, 'the second pass must not fit in the budget'
+	print("partial:", partial)
+	# The setup swap found by the cut short pass is played, not a random one
+	assert ai.chooseSwap(grid, 2, None, 100, random.Random(22)) == partial[1] == (1, 2)
+
+def test23():
+	import log, tempfile, os
+	with tempfile.TemporaryDirectory() as directory:
+		log.configure(os.path.join(directory, 'first.log'))
+		first = log._listener.handlers[0]
+		DEBUG("first")
+		log.configure(os.path.join(directory, 'second.log'))
+		DEBUG("second")
+		assert first.stream == None # Closed
+		log.shutdown()
+		with open(os.path.join(directory, 'first.log')) as f: assert f.read() == "first\n"
+		with open(os.path.join(directory, 'second.log')) as f: assert f.read() == "second\n"
+	log.configure(os.devnull, level=log.logging.CRITICAL + 1) # Nothing logged by the next tests
+	log.shutdown()
+
+def test24():
+	_grid = rotateMatrix([\
+	[0, 0, 0, 0, 0],
+	[0, 0, 0, 0, 0],
+	[2, 1, 0, 1, 0],
+	[1, 3, 2, 0, 3],
+	[1, 1, 1, 0, 2]])
+	game = Game([Player('Human', 'Human')], seed=24)
+	player = game.players[0]
+	player.grid = Grid(data=_grid, nbSymbols=5)
+	player.stateMachine = Scheduler() # No block spawned
+	sm = player.stateMachine
+	combos = lambda: [state.data for state in sm.ofKind("combo")]
+	index = lambda: {pos: [(state.key, i) for state, i in entries] for pos, entries in player.comboIndex.items()}
+
+	assert game.checkAndCombo(player, "fall", [(0, 4)]) == [Combo.fromRun(0, 4, 3, 'h', 1)]
+	game.checkAndFall(player)
+	while sm.count("fall"): game.tick()
+	print(player.grid.reprBlocks())
+	row = Combo.fromRun(0, 4, 4, 'h', 1) # Extended by the block fallen in column 3
+	assert combos() == [[row]]
+	assert index() == {(x, 4): [(("combo", 0), 0)] for x in range(4)}
+
+	assert game.checkAndCombo(player, "fall", [(1, 4)]) == [] # Already found
+	player.swapperPos = (0, 2)
+	sm.transition(("fall", 0), 1, (0, 0))
+	game.swap(player) # Vertical combo sharing one block with the row, in a falling column
+	assert combos() == [[row]]
+	sm.delete(("fall", 0))
+	column = Combo.fromRun(0, 2, 3, 'v', 1)
+	assert game.checkAndCombo(player, "swap", (0, 2)) == [column]
+	print("combos:", combos())
+	assert combos() == [[row], [column]]
+	expected = {(x, 4): [(("combo", 0), 0)] for x in range(4)}
+	for y in (2, 3, 4): expected.setdefault((0, y), []).append((("combo", 1), 0))
+	assert index() == expected
+
+	while sm.count("combo"): game.tick()
+	print(player.grid.reprBlocks())
+	print("score:", player.score, "combos:", player.nbCombos)
+	assert player.comboIndex == {}
+	assert (player.score, player.nbCombos) == (scoreIt(4), 1) # The column lost its bottom block
+
 if __name__ == '__main__':
 	#print("\033[104mkuro\033[00mmatsu")
 	test9()
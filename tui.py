@@ -1,27 +1,41 @@
 #!/usr/bin/env python3
 # -*- coding: Utf-8 -*-
 
-"""Textual User Interface for Swap"""
+"""Textual User Interface for Swap
 
+usage: tui.py [REPLAY] [--spectate GAMES [-j JOBS] [--seed SEED]] [--log FILE] [--profile]
+
+Keys: arrows move the swapper, x swaps, space pauses, p toggles profiling,
+q quits.
+"""
+
+import os
 import sys
-from time import time
+import argparse
+import multiprocessing
+from time import time, sleep
 from random import randrange
-from itertoolsExt import flatten
 import urwid
 
 import swap
+import replay
+from grid import groupPositions
+from itertoolsExt import flatten
 from log import *
 
+PROFILE_FILE = 'swap.prof' # Report written when profiling is toggled off
+
 class TUI(object):
 	COLORS = [('k', 'black'), ('r', 'dark red'), ('w', 'brown'), ('b', 'dark blue'),
 	('g', 'dark green'), ('m', 'dark magenta'), ('c', 'dark cyan'), ('z', 'light gray')]
 
-	def __init__(self):
-		self.GAME_DT = .05
+	def __init__(self, replayFile=None):
+		self.GAME_DT = swap.Game.TICK
 		self.UI_DT = .1
 		self.timer = self.UI_DT
 		self.last_time = time()
 		self.game = swap.Game()
+		self.recorder = replay.Recorder(self.game, replayFile) if replayFile else None
 
 		self.buildUI()
 		self.updateUI()
@@ -34,11 +48,9 @@ class TUI(object):
 
 		header = urwid.AttrMap(urwid.Text('Swap', align='center'), 'title')
 
-		leftGrid = urwid.Text('')
-		leftCont = urwid.LineBox(urwid.Filler(leftGrid, 'top'))
-
-		rightGrid = urwid.Text('')
-		rightCont = urwid.LineBox(urwid.Filler(rightGrid, 'top'))
+		self.boardViews = [BoardView(player) for player in self.game.players]
+		leftCont = urwid.LineBox(urwid.Filler(self.boardViews[0].widget, 'top'))
+		rightCont = urwid.LineBox(urwid.Filler(self.boardViews[1].widget, 'top'))
 
 		scoreTitle = urwid.AttrMap(urwid.Text('Score', align='center'), 'title')
 		scoreCont = urwid.Filler(scoreTitle, 'top', top=2)
@@ -64,7 +76,6 @@ class TUI(object):
 
 		frame = urwid.Frame(header=header, body=columns)
 
-		self.leftGrid, self.rightGrid = leftGrid, rightGrid
 		self.scoreLabel = scoreLabel
 		self.multiplierLabel = multiplierLabel
 		self.stateLabel = stateLabel
@@ -82,19 +93,24 @@ class TUI(object):
 			self.game.processInputEvent("swap")
 		elif key == '+':
 			self.scoreLabel.base_widget.set_text("test")
+		elif key == 'p':
+			toggleProfiling()
 		elif key in ('q', 'Q'):
 			raise urwid.ExitMainLoop()
 
 	def run(self):
 		self.mainLoop.set_alarm_in(1, self.update)
 		self.mainLoop.set_alarm_in(1, self.updateDebugUI)
-		self.mainLoop.run()
+		try:
+			self.mainLoop.run()
+		finally:
+			if self.recorder: self.recorder.close()
 
 	def updateUI(self):
-		self.leftGrid.set_text(self.buildMarkup(self.game.players[0]))
-		self.rightGrid.set_text(self.buildMarkup(self.game.players[1]))
-		self.scoreLabel.set_text('%s | %s' % (self.game.players[0].score, self.game.players[1].score))
-		self.multiplierLabel.set_text('x%s | x%s' % (self.game.players[0].scoreMultiplier, self.game.players[1].scoreMultiplier))
+		for view in self.boardViews:
+			view.update(comboPositions(self.game, view.player))
+		setText(self.scoreLabel, '%s | %s' % (self.game.players[0].score, self.game.players[1].score))
+		setText(self.multiplierLabel, 'x%s | x%s' % (self.game.players[0].scoreMultiplier, self.game.players[1].scoreMultiplier))
 
 	def update(self, loop, userData):
 		
@@ -113,32 +129,235 @@ class TUI(object):
 
 	def updateDebugUI(self, loop, userData):
 		if not self.game.pause:
-			self.stateLabel.set_text('%s\n%s' % (self.game.players[0].stateMachine.vcrepr(), self.game.players[1].stateMachine.vcrepr()))
+			setText(self.stateLabel, '%s\n%s' % (self.game.players[0].stateMachine.vcrepr(), self.game.players[1].stateMachine.vcrepr()))
 		self.mainLoop.set_alarm_in(.2, self.updateDebugUI)
 
-	def buildMarkup(self, player):
-		out = []
-		color, chars = None, None
-		comboGroups = self.game.getComboGroups(player)
-		#DEBUG("Markup combo groups: %s", comboGroups)
-		for y in range(player.grid.height):
-			for x in range(player.grid.width):
-				color, chars = TUI.COLORS[player.grid[x][y]][0], [' ', ' ']
-
-				for cg in comboGroups:
-					for block in set(flatten(cg)):
-						if block.pos == (x, y):
-							chars = ['*', '*']
-
-				spx, spy = player.swapperPos
-				if spy == y and spx == x:
-					chars[0] = '['
-				elif spy == y and spx+1 == x:
-					chars[1] = ']'
-
-				out.append((color, ''.join(chars)))
-			out.append('\n')
-		return out
+class BoardView(object):
+	"""Grid of a player, drawn as one text widget per row.
+
+Each row keeps the blocks, combo highlights and swapper position it was last
+drawn with, and is only drawn again when one of them changes."""
+
+	def __init__(self, player):
+		self.player = player
+		self.rows = [urwid.Text('', wrap='clip') for y in range(player.grid.height)]
+		self.drawn = [None] * player.grid.height # Content of each row when last drawn
+		self.widget = urwid.Pile(self.rows)
+
+	def update(self, comboPositions):
+		"""Draw the rows that changed, highlighting the blocks at comboPositions.
+Return the number of rows drawn."""
+		grid = self.player.grid
+		highlighted = {} # x of the combo blocks, by row
+		for x, y in comboPositions:
+			highlighted.setdefault(y, set()).add(x)
+		spx, spy = self.player.swapperPos
+
+		nbDrawn = 0
+		for y, row in enumerate(self.rows):
+			content = (grid.row(y), frozenset(highlighted.get(y, ())), spx if spy == y else None)
+			if content != self.drawn[y]:
+				self.drawn[y] = content
+				row.set_text(rowMarkup(*content))
+				nbDrawn += 1
+		return nbDrawn
+
+def rowMarkup(blocks, highlighted, swapperX):
+	out = []
+	for x, block in enumerate(blocks):
+		chars = ['*', '*'] if x in highlighted else [' ', ' ']
+		if x == swapperX:
+			chars[0] = '['
+		elif swapperX != None and x == swapperX + 1:
+			chars[1] = ']'
+		out.append((TUI.COLORS[block][0], ''.join(chars)))
+	return out
+
+def comboPositions(game, player):
+	"""Return the positions of the pending combo blocks of player"""
+	return set(flatten(groupPositions(comboGroup) for comboGroup in game.getComboGroups(player)))
+
+class GridImage(object):
+	"""Copy of the blocks of a grid, received from another process"""
+
+	def __init__(self, width, height):
+		self.width, self.height = width, height
+		self.blocks = bytes(width * height) # Column by column, as in Grid
+
+	def row(self, y):
+		return self.blocks[y::self.height]
+
+class PlayerImage(object):
+	"""What a spectator draws of a player playing in another process"""
+
+	def __init__(self):
+		self.grid = GridImage(*swap.Player.GRID_SIZE[:2])
+		self.swapperPos = (0, 0)
+		self.score = 0
+		self.scoreMultiplier = 1
+		self.comboPositions = ()
+
+def imageOf(game):
+	"""Return the images of the players of game, as sent by playGames"""
+	return [(b''.join(player.grid), player.swapperPos, player.score, player.scoreMultiplier,
+		tuple(comboPositions(game, player))) for player in game.players]
+
+def playGames(seeds, connection, frameDt):
+	"""Play the seeded AI vs AI games on the wall clock, in a worker process.
+
+Every frameDt, the images of the games are sent through connection. A
+boolean received pauses or resumes the games, None stops them."""
+	games = [swap.Game([swap.Player('AI', 'BOT#0'), swap.Player('AI', 'BOT#1')], seed)
+		for seed in seeds]
+	try:
+		while True:
+			while connection.poll():
+				pause = connection.recv()
+				if pause == None: return
+				for game in games: game.pause = pause
+			for game in games: game.update()
+			connection.send([imageOf(game) for game in games])
+			sleep(frameDt)
+	except (EOFError, BrokenPipeError):
+		pass
+
+class Spectator(object):
+	"""Dashboard tiling many AI vs AI games.
+
+The games are played by worker processes, so that AI searches never stall
+the interface. Each worker sends the images of its games every frame, and
+boards are drawn at a rate that slows down while they do not change. At most
+ROW_BUDGET rows are drawn per frame, the boards that waited the longest first."""
+	FRAME_DT = .1 # Time between frames, in seconds
+	MIN_REFRESH, MAX_REFRESH = .1, 1.6 # Bounds of the time between draws of a board
+	ROW_BUDGET = 120 # Maximal number of rows drawn per frame
+
+	def __init__(self, nbGames, seed=0, jobs=None):
+		self.seeds = list(range(seed, seed + nbGames))
+		self.tiles = [GameTile([PlayerImage(), PlayerImage()], ' #{} '.format(seed)) for seed in self.seeds]
+		self.jobs = min(nbGames, jobs or os.cpu_count())
+		self.workers = [] # (process, connection, indices of its games)
+
+		palette = [('title', 'white,bold', 'black')]
+		palette.extend((name, 'white', style) for name, style in TUI.COLORS)
+		header = urwid.AttrMap(urwid.Text('Swap - {} games'.format(nbGames), align='center'), 'title')
+		body = urwid.GridFlow([tile.widget for tile in self.tiles], GameTile.WIDTH, 1, 0, 'left')
+		self.mainLoop = urwid.MainLoop(urwid.Frame(urwid.Filler(body, 'top'), header=header),
+			palette, unhandled_input=self.handleInput)
+		self.pause = False
+
+	def handleInput(self, key):
+		if key == ' ':
+			self.pause = not self.pause
+			for process, connection, indices in self.workers:
+				connection.send(self.pause)
+		elif key == 'p':
+			toggleProfiling()
+		elif key in ('q', 'Q'):
+			raise urwid.ExitMainLoop()
+
+	def run(self):
+		for j in range(self.jobs):
+			connection, workerConnection = multiprocessing.Pipe()
+			indices = range(j, len(self.seeds), self.jobs)
+			process = multiprocessing.Process(target=playGames, daemon=True,
+				args=([self.seeds[i] for i in indices], workerConnection, self.FRAME_DT))
+			process.start()
+			self.workers.append((process, connection, indices))
+		self.mainLoop.set_alarm_in(0, self.update)
+		self.mainLoop.set_alarm_in(0, self.draw)
+		try:
+			self.mainLoop.run()
+		finally:
+			for process, connection, indices in self.workers:
+				connection.send(None)
+			for process, connection, indices in self.workers:
+				process.join(1)
+				if process.is_alive(): process.terminate()
+
+	def update(self, loop, userData):
+		"""Apply the last images received from the workers"""
+		for process, connection, indices in self.workers:
+			images = None
+			while connection.poll():
+				images = connection.recv()
+			if images == None: continue
+			for i, gameImage in zip(indices, images):
+				for player, image in zip(self.tiles[i].players, gameImage):
+					player.grid.blocks, player.swapperPos, player.score, \
+						player.scoreMultiplier, player.comboPositions = image
+		self.mainLoop.set_alarm_in(self.FRAME_DT, self.update)
+
+	def draw(self, loop, userData):
+		"""Draw the boards that are due, within the row budget"""
+		now, budget = time(), self.ROW_BUDGET
+		for tile in sorted(self.tiles, key=lambda tile: tile.due):
+			if tile.due > now or budget <= 0: break
+			nbDrawn = tile.draw()
+			budget -= nbDrawn
+			if nbDrawn: tile.interval = self.MIN_REFRESH
+			else: tile.interval = min(2 * tile.interval, self.MAX_REFRESH)
+			tile.due = now + tile.interval
+		self.mainLoop.set_alarm_in(self.FRAME_DT, self.draw)
+
+class GameTile(object):
+	"""Scores and boards of the player images of a game"""
+	WIDTH = 2 * (12*2) + 1 + 2 # Boards, separator and borders
+
+	def __init__(self, players, title):
+		self.players = players
+		self.views = [BoardView(player) for player in players]
+		self.label = urwid.Text('', align='center')
+		boards = urwid.Columns([(player.grid.width * 2, view.widget)
+			for player, view in zip(players, self.views)], dividechars=1)
+		self.widget = urwid.LineBox(urwid.Pile([self.label, boards]), title=title)
+		self.interval = Spectator.MIN_REFRESH
+		self.due = 0 # Time of the next draw
+
+	def draw(self):
+		"""Draw the rows of the boards that changed. Return their number."""
+		setText(self.label, ' | '.join('{} x{}'.format(player.score, player.scoreMultiplier)
+			for player in self.players))
+		return sum(view.update(view.player.comboPositions) for view in self.views)
+
+def toggleProfiling():
+	"""Start profiling, or stop it and write the report to PROFILE_FILE"""
+	if isProfiling():
+		stopProfiling()
+		with open(PROFILE_FILE, 'w') as f: f.write(report() + '\n')
+	else:
+		resetTimers()
+		startProfiling()
+
+def setText(widget, text):
+	"""Set the text of widget, unless unchanged, so that it is not redrawn"""
+	if widget.text != text: widget.set_text(text)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Play Swap in the terminal.')
+	parser.add_argument('replay', nargs='?', help='file to record the replay of the game to')
+	parser.add_argument('--spectate', type=int, metavar='GAMES', help='watch GAMES AI vs AI games instead')
+	parser.add_argument('--seed', type=int, default=0, help='seed of the first spectated game')
+	parser.add_argument('-j', '--jobs', type=int, help='number of processes playing the spectated games')
+	parser.add_argument('--log', metavar='FILE', help='write the debug log to FILE')
+	parser.add_argument('--profile', action='store_true', help='time the hot functions and print a report at exit')
+	args = parser.parse_args(argv)
+	if args.seed < 0: parser.error('SEED must not be negative')
+
+	if args.log: configure(args.log)
+	if args.profile: startProfiling()
+
+	if args.spectate:
+		Spectator(args.spectate, args.seed, args.jobs).run()
+	else:
+		TUI(args.replay).run()
+
+	if isProfiling():
+		stopProfiling()
+		print(report())
+
+profile(TUI, 'updateUI')
+profile(BoardView, 'update')
 
 if __name__ == '__main__':
-	TUI().run()
+	main()